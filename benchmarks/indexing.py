@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Benchmark the indexing of a synthetic library.
+
+Generates a library of stories (with metadata and backstory pages) in a
+temporary directory and times a cold reload (no cache), a warm reload
+(nothing changed) and an incremental reload (some stories changed), as well
+as reading all backstories with get_backstory_data. Every run is done in a
+fresh process, so that the peak memory usage can be reported per run.
+
+Run from the repository's root directory:
+
+    python -m benchmarks.indexing --stories 1000 10000 100000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sapfo.index.indexing import StoryIndex, get_backstory_data, walk_stories
+from sapfo.taggedlist import builtin_attrs
+
+RUNS = ['cold', 'warm', 'incremental', 'backstory']
+
+
+class CorpusOptions(NamedTuple):
+    stories: int
+    # Average number of words per story
+    words: int
+    # Number of words in every story's description
+    description_words: int
+    # Number of different tags in the library
+    tag_vocabulary: int
+    tags_per_story: int
+    # The share of the stories that have a backstory directory
+    backstory_ratio: float
+    # Number of pages per backstory directory
+    backstory_pages: int
+    words_per_page: int
+    stories_per_dir: int
+    seed: int
+
+
+class DummyProgress:
+    """
+    A progress object that does nothing, so no GUI is needed.
+    """
+    def setLabelText(self, text: str) -> None:
+        pass
+
+    def setMaximum(self, maximum: int) -> None:
+        pass
+
+    def setValue(self, progress: int) -> None:
+        pass
+
+    def wasCanceled(self) -> bool:
+        return False
+
+
+def _text(rng: random.Random, vocabulary: List[str], words: int) -> str:
+    lines = []
+    for start in range(0, words, 12):
+        lines.append(' '.join(rng.choices(vocabulary,
+                                          k=min(12, words - start))))
+    return '\n'.join(lines)
+
+
+def generate_corpus(root: Path, options: CorpusOptions) -> int:
+    """
+    Write a library of stories to root and return the number of files
+    that were written.
+    """
+    rng = random.Random(options.seed)
+    vocabulary = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyzåäö',
+                                      k=rng.randint(1, 10)))
+                  for _ in range(2000)]
+    tags = [f'tag{n}' for n in range(options.tag_vocabulary)]
+    files = 0
+    for n in range(options.stories):
+        dir_root = root / f'dir{n // options.stories_per_dir:04}'
+        if n % options.stories_per_dir == 0:
+            dir_root.mkdir(parents=True)
+        name = f'story{n:06}.txt'
+        words = rng.randint(options.words // 2, options.words * 3 // 2)
+        (dir_root / name).write_text(_text(rng, vocabulary, words),
+                                     encoding='utf-8')
+        metadata = {
+            'title': f'Story {n}',
+            'description': ' '.join(rng.choices(vocabulary,
+                                                k=options.description_words)),
+            'tags': rng.sample(tags, min(options.tags_per_story, len(tags))),
+        }
+        (dir_root / f'.{name}.metadata').write_text(json.dumps(metadata),
+                                                    encoding='utf-8')
+        files += 2
+        if rng.random() < options.backstory_ratio:
+            metadir = dir_root / f'{name}.metadir'
+            metadir.mkdir()
+            for page in range(options.backstory_pages):
+                header = json.dumps({'title': f'Page {page}'})
+                text = _text(rng, vocabulary, options.words_per_page)
+                (metadir / f'page{page}').write_text(f'{header}\n{text}',
+                                                     encoding='utf-8')
+            files += options.backstory_pages
+    # Files modified in the last few seconds are always read again by the
+    # index, so make everything look old to get realistic warm reloads
+    old = time.time() - 3600
+    for dir_root, dirnames, filenames in os.walk(root):
+        for name in filenames + dirnames:
+            os.utime(os.path.join(dir_root, name), (old, old))
+    os.utime(root, (old, old))
+    return files
+
+
+def change_corpus(root: Path, share: float, seed: int) -> int:
+    """
+    Change the text and metadata of a share of the stories, and return
+    how many were changed.
+    """
+    rng = random.Random(seed)
+    stories = sorted(story.file for story in walk_stories(root))
+    changed = rng.sample(stories, max(1, int(len(stories) * share)))
+    for file in changed:
+        with file.open('a', encoding='utf-8') as f:
+            f.write(' a few more words')
+        metadata_file = file.with_name(f'.{file.name}.metadata')
+        metadata = json.loads(metadata_file.read_text(encoding='utf-8'))
+        metadata['title'] += ' (edited)'
+        metadata_file.write_text(json.dumps(metadata), encoding='utf-8')
+    return len(changed)
+
+
+def _peak_rss_kib() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run(name: str, root: Path, cache_dir: Path, workers: int,
+         processes: int, results: Any) -> None:
+    start = time.perf_counter()
+    if name == 'backstory':
+        count = 0
+        for story in walk_stories(root):
+            if story.has_metadir:
+                get_backstory_data(story.file, {})
+                count += 1
+    else:
+        count = len(StoryIndex(cache_dir).update(
+            root, DummyProgress(), builtin_attrs, workers=workers,
+            processes=processes))
+    duration = time.perf_counter() - start
+    results.put({'run': name, 'seconds': duration, 'stories': count,
+                 'stories_per_second': count / duration if duration else 0,
+                 'peak_rss_kib': _peak_rss_kib()})
+
+
+def run_in_process(name: str, root: Path, cache_dir: Path, workers: int,
+                   processes: int) -> Dict[str, Any]:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run, args=(name, root, cache_dir,
+                                                 workers, processes, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'The {name} run failed')
+    result: Dict[str, Any] = results.get()
+    return result
+
+
+def benchmark(stories: int, options: CorpusOptions, runs: List[str],
+              workers: int, processes: int, changed_share: float,
+              directory: Optional[Path]) -> List[Dict[str, Any]]:
+    base = Path(tempfile.mkdtemp(prefix='sapfo-bench-', dir=directory))
+    try:
+        root = base / 'library'
+        cache_dir = base / 'cache'
+        start = time.perf_counter()
+        files = generate_corpus(root, options._replace(stories=stories))
+        print(f'# {stories} stories: generated {files} files in '
+              f'{time.perf_counter() - start:.1f} s', file=sys.stderr)
+        results = []
+        for name in runs:
+            if name == 'warm' and 'cold' not in runs:
+                run_in_process('cold', root, cache_dir, workers, processes)
+            elif name == 'incremental':
+                if not cache_dir.exists():
+                    run_in_process('cold', root, cache_dir, workers,
+                                   processes)
+                change_corpus(root, changed_share, options.seed)
+            result = run_in_process(name, root, cache_dir, workers,
+                                    processes)
+            result['library_size'] = stories
+            results.append(result)
+            print(f'{stories:>8} {name:<12} {result["seconds"]:>9.3f} s '
+                  f'{result["stories_per_second"]:>11.0f} stories/s '
+                  f'{result["peak_rss_kib"] / 1024:>8.1f} MiB peak RSS')
+        return results
+    finally:
+        shutil.rmtree(base)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--stories', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='library sizes to benchmark '
+                        '(default: 1000 10000 100000)')
+    parser.add_argument('--runs', nargs='+', choices=RUNS, default=RUNS,
+                        help='which reloads to time (default: all)')
+    parser.add_argument('--words', type=int, default=500,
+                        help='average number of words per story')
+    parser.add_argument('--description-words', type=int, default=30)
+    parser.add_argument('--tag-vocabulary', type=int, default=200)
+    parser.add_argument('--tags-per-story', type=int, default=5)
+    parser.add_argument('--backstory-ratio', type=float, default=0.3,
+                        help='share of the stories that have a backstory')
+    parser.add_argument('--backstory-pages', type=int, default=5)
+    parser.add_argument('--words-per-page', type=int, default=300)
+    parser.add_argument('--stories-per-dir', type=int, default=100)
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help='share of the stories to change before the '
+                        'incremental reload (default: 0.01)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', type=Path,
+                        help='where to create the temporary library')
+    parser.add_argument('--json', type=Path,
+                        help='also write the results to this file')
+    args = parser.parse_args()
+    options = CorpusOptions(
+        stories=0, words=args.words,
+        description_words=args.description_words,
+        tag_vocabulary=args.tag_vocabulary,
+        tags_per_story=args.tags_per_story,
+        backstory_ratio=args.backstory_ratio,
+        backstory_pages=args.backstory_pages,
+        words_per_page=args.words_per_page,
+        stories_per_dir=args.stories_per_dir,
+        seed=args.seed,
+    )
+    results = []
+    for stories in args.stories:
+        results.extend(benchmark(stories, options, args.runs, args.workers,
+                                 args.processes, args.changed, args.dir))
+    if args.json:
+        args.json.write_text(json.dumps({
+            'time': time.time(),
+            'python': sys.version,
+            'cpus': os.cpu_count(),
+            'options': {**options._asdict(), 'workers': args.workers,
+                        'processes': args.processes,
+                        'changed': args.changed},
+            'results': results,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
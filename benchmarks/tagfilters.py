@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark parsing very long and very deeply nested tag filters.
+
+Times tokenizing and parsing generated filters of different sizes: long
+flat AND and OR groups, deeply nested groups (alternating between AND and
+OR, with some of them negated), and filters using a chain of tag macros
+with many tags in them.
+
+Run from the repository's root directory:
+
+    python -m benchmarks.tagfilters --sizes 100 1000 10000 100000
+"""
+import argparse
+import sys
+import time
+from typing import Callable, Dict, Tuple
+
+from sapfo.tagsystem import TagMacros, _read_from, _tokenize
+
+KINDS = ['or', 'and', 'nested', 'macros']
+
+
+def long_filter(size: int, separator: str) -> str:
+    return separator.join(f'{"-" if n % 7 == 0 else ""}tag{n}'
+                          for n in range(size))
+
+
+def nested_filter(depth: int) -> str:
+    parts = []
+    for n in range(depth):
+        negation = '-' if n % 3 == 0 else ''
+        separator = ', ' if n % 2 == 0 else ' | '
+        parts.append(f'tag{n}{separator}{negation}(')
+    return ''.join(parts) + 'last' + ')' * depth
+
+
+def macro_filter(size: int) -> Tuple[str, Dict[str, str]]:
+    """
+    Return a filter with macros that use each other in a chain, with size
+    tags in total.
+    """
+    per_macro = 100
+    count = max(1, size // per_macro)
+    macros = {}
+    for n in range(count):
+        tags = ' | '.join(f'tag{n}_{m}' for m in range(per_macro))
+        macros[f'm{n}'] = tags if n == 0 else f'{tags} | @m{n - 1}'
+    return f'@m{count - 1}, -tagx', macros
+
+
+def _time(function: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(kind: str, size: int, repeat: int) -> None:
+    macros: Dict[str, str] = {}
+    if kind == 'or':
+        string = long_filter(size, ' | ')
+    elif kind == 'and':
+        string = long_filter(size, ', ')
+    elif kind == 'nested':
+        string = nested_filter(size)
+    else:
+        string, macros = macro_filter(size)
+    tokens = _tokenize(string)
+    tokenize_time = _time(lambda: _tokenize(string), repeat)
+    if macros:
+        macros_time = _time(lambda: TagMacros(macros), repeat)
+        compiled_macros = TagMacros(macros)
+        parse_time = _time(lambda: _read_from(tokens, compiled_macros.group),
+                           repeat)
+    else:
+        macros_time = 0.0
+        parse_time = _time(lambda: _read_from(tokens), repeat)
+    print(f'{kind:<8} {size:>8} {len(string):>10} chars '
+          f'{tokenize_time * 1000:>10.2f} ms tokenize '
+          f'{parse_time * 1000:>10.2f} ms parse '
+          f'{macros_time * 1000:>10.2f} ms macros')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000],
+                        help='number of tags (or nesting depth) '
+                        '(default: 100 1000 10000 100000)')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS,
+                        help='which filters to time (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='how many times to run each step, the best '
+                        'time is shown (default: 3)')
+    args = parser.parse_args()
+    for kind in args.kinds:
+        for size in args.sizes:
+            benchmark(kind, size, args.repeat)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
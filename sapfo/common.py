@@ -48,6 +48,8 @@ class Settings(QObject):
     editor_changed = mk_signal1(str)
     formatting_converters_changed: Signal1[List[List[str]]] = mk_signal1(list)
     hotkeys_changed: Signal1[Dict[str, str]] = mk_signal1(dict)
+    index_processes_changed = mk_signal1(int)
+    index_workers_changed = mk_signal1(int)
     path_changed = mk_signal1(Path)
     tag_colors_changed: Signal1[Dict[str, str]] = mk_signal1(dict)
     tag_macros_changed: Signal1[Dict[str, str]] = mk_signal1(dict)
@@ -63,6 +65,8 @@ class Settings(QObject):
         self.editor = ''
         self.formatting_converters: List[List[str]] = []
         self.hotkeys: Dict[str, str] = {}
+        self.index_processes = 0
+        self.index_workers = 4
         self.path = Path('/')
         self.tag_colors: Dict[str, str] = {}
         self.tag_macros: Dict[str, str] = {}
@@ -134,6 +138,14 @@ class Settings(QObject):
               self.formatting_converters_changed)
         # Hotkeys
         self.hotkeys = u(get('hotkeys'), self.hotkeys, self.hotkeys_changed)
+        # Index processes
+        self.index_processes = \
+            u(get('index processes'), self.index_processes,
+              self.index_processes_changed)
+        # Index workers
+        self.index_workers = \
+            u(get('index workers'), self.index_workers,
+              self.index_workers_changed)
         # Path
         self.path = u(Path(get('path')).expanduser(),
                       self.path, self.path_changed)
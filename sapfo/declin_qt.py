@@ -1,5 +1,6 @@
 from datetime import datetime
-from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, cast
+from typing import (Any, Dict, Iterable, List, NamedTuple, Optional, Set,
+                    Tuple, cast)
 
 from PyQt5.QtCore import QRect, QRectF, QSize, Qt
 from PyQt5.QtGui import QColor, QFont, QFontMetrics, QPainter, QPen
@@ -312,3 +313,32 @@ def calc_size(input_value: Dict[str, Any], section: Section, model: Model,
         return calc_size_line(section, rect, depth)
     else:
         raise NotImplementedError(str(type(section)))
+
+
+def uses_attribute(model: Model, attribute: str) -> bool:
+    """
+    Return True if the layout of an entry may depend on the attribute,
+    which is the case if any section that gets the whole entry shows it (or
+    the whole entry).
+    """
+    names = (attribute, '')
+    visited: Set[str] = set()
+
+    def visit(name: str) -> bool:
+        section = model.sections.get(name)
+        if name in visited or section is None:
+            return False
+        visited.add(name)
+        if isinstance(section, ContainerSection):
+            if isinstance(section.source, list):
+                return any(visit(ref.name) for ref in section.source)
+            attr, _ = section.source
+            return attr.name in names
+        elif isinstance(section, ItemSection):
+            if any(isinstance(x, AttributeRef) and x.name in names
+                   for x in section.data):
+                return True
+            return section.when_empty is not None \
+                and visit(section.when_empty.name)
+        return False
+    return visit(model.main)
@@ -0,0 +1,255 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from ..taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
+                          ATTR_FILE, ATTR_INDEX, ATTR_LAST_MODIFIED,
+                          ATTR_METADATA_FILE, ATTR_WORDCOUNT, AttributeData,
+                          Entry)
+
+
+class DirState(NamedTuple):
+    mtime: int
+    # (file name, has a backstory directory) for every story in the directory
+    stories: Tuple[Tuple[str, bool], ...]
+    subdirs: Tuple[str, ...]
+
+
+class PageState(NamedTuple):
+    mtime: int
+    size: int
+    # None if the page couldn't be read
+    words: Optional[int]
+
+
+class BackstoryDirState(NamedTuple):
+    mtime: int
+    # The backstory pages directly in the directory, by file name
+    pages: Dict[str, PageState]
+    subdirs: Tuple[str, ...]
+
+
+# The state of every directory in a story's backstory directory
+BackstoryState = Dict[Path, BackstoryDirState]
+
+
+class StoryState(NamedTuple):
+    metadata_mtime: int
+    # The story file's mtime in nanoseconds and size
+    mtime: int
+    size: int
+    entry: Entry
+    backstory: BackstoryState
+
+
+# The attributes that are read from the story's files and not its metadata
+FILE_ATTRIBUTES = frozenset([
+    ATTR_INDEX, ATTR_BACKSTORY_WORDCOUNT, ATTR_BACKSTORY_PAGES,
+    ATTR_WORDCOUNT, ATTR_FILE, ATTR_LAST_MODIFIED, ATTR_METADATA_FILE,
+])
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    stories TEXT NOT NULL,
+    subdirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stories (
+    file TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    metadata_file TEXT NOT NULL,
+    metadata_mtime INTEGER NOT NULL,
+    metadata TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    wordcount INTEGER NOT NULL,
+    backstory_wordcount INTEGER NOT NULL,
+    backstory_pages INTEGER NOT NULL,
+    backstory TEXT NOT NULL
+);
+'''
+
+# Stored in the database's header, to recognize it as a cache of ours
+_APPLICATION_ID = 0x73617066  # "sapf"
+# Bump this when the schema (or what is stored in it) changes, to throw
+# away the old cache
+_SCHEMA_VERSION = 4
+
+
+def _encode_backstory(backstory: BackstoryState) -> str:
+    return json.dumps({
+        str(path): [state.mtime, state.pages, state.subdirs]
+        for path, state in backstory.items()
+    })
+
+
+def _decode_backstory(raw_backstory: str) -> BackstoryState:
+    data: Dict[str, Any] = json.loads(raw_backstory)
+    return {
+        Path(path): BackstoryDirState(
+            mtime,
+            {name: PageState(*page) for name, page in pages.items()},
+            tuple(subdirs))
+        for path, (mtime, pages, subdirs) in data.items()
+    }
+
+
+def _encode_metadata(entry: Entry) -> str:
+    return json.dumps({
+        key: sorted(value) if isinstance(value, frozenset) else value
+        for key, value in entry.as_dict().items()
+        if key not in FILE_ATTRIBUTES
+    })
+
+
+class IndexCache:
+    """
+    The state of a StoryIndex, saved in an SQLite database.
+
+    Saving only writes the rows that changed, in a single transaction.
+    The cache may be used from another thread than the one that created
+    it, as long as it's only used from one thread at a time.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                self._db = self._open()
+            except sqlite3.DatabaseError:
+                # Not a database at all, or a broken one
+                self.path.unlink(missing_ok=True)
+                self._db = self._open()
+            # The caches from before there was a database
+            for old_cache in ['index.pickle', 'manifest.pickle']:
+                (self.path.parent / old_cache).unlink(missing_ok=True)
+        return self._db
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(str(self.path), check_same_thread=False)
+        try:
+            # Both of these are read from the file's header
+            application_id = db.execute('PRAGMA application_id').fetchone()[0]
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if application_id != _APPLICATION_ID \
+                    or version != _SCHEMA_VERSION:
+                self._drop_tables(db)
+            db.executescript(_SCHEMA)
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+
+    @staticmethod
+    def _drop_tables(db: sqlite3.Connection) -> None:
+        with db:
+            for table in ['info', 'directories', 'stories']:
+                db.execute(f'DROP TABLE IF EXISTS {table}')
+            db.execute(f'PRAGMA application_id = {_APPLICATION_ID}')
+            db.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        # Give the space of removed stories back to the file system
+        # automatically from now on
+        db.execute('PRAGMA auto_vacuum = FULL')
+        db.execute('VACUUM')
+
+    def load(self, attributes: AttributeData
+             ) -> Tuple[Dict[Path, DirState], Dict[Path, StoryState]]:
+        """
+        Return the saved directory and story states. The stories are only
+        returned if they were saved with the same attributes.
+
+        If the cache can't be read, it's cleared and nothing is returned.
+        """
+        db = self._connect()
+        try:
+            return self._load(db, attributes)
+        except (sqlite3.DatabaseError, ValueError, KeyError, TypeError):
+            self._drop_tables(db)
+            db.executescript(_SCHEMA)
+            return {}, {}
+
+    def _load(self, db: sqlite3.Connection, attributes: AttributeData
+              ) -> Tuple[Dict[Path, DirState], Dict[Path, StoryState]]:
+        dirs = {
+            Path(path): DirState(mtime,
+                                 tuple((name, bool(has_metadir))
+                                       for name, has_metadir
+                                       in json.loads(stories)),
+                                 tuple(json.loads(subdirs)))
+            for path, mtime, stories, subdirs
+            in db.execute('SELECT path, mtime, stories, subdirs '
+                          'FROM directories')
+        }
+        row = db.execute("SELECT value FROM info WHERE key = 'attributes'"
+                         ).fetchone()
+        if row is None or json.loads(row[0]) != sorted(attributes):
+            return dirs, {}
+        stories = {}
+        for (file, position, metadata_file, metadata_mtime, metadata, mtime,
+             mtime_ns, size, wordcount, backstory_wordcount, backstory_pages,
+             backstory) \
+                in db.execute('SELECT file, position, metadata_file, '
+                              'metadata_mtime, metadata, mtime, mtime_ns, '
+                              'size, wordcount, backstory_wordcount, '
+                              'backstory_pages, backstory '
+                              'FROM stories ORDER BY position'):
+            entry_dict = {key: attributes[key]._load_value(value)
+                          for key, value in json.loads(metadata).items()}
+            entry_dict[ATTR_INDEX] = position
+            entry_dict[ATTR_BACKSTORY_WORDCOUNT] = backstory_wordcount
+            entry_dict[ATTR_BACKSTORY_PAGES] = backstory_pages
+            entry_dict[ATTR_WORDCOUNT] = wordcount
+            entry_dict[ATTR_FILE] = Path(file)
+            entry_dict[ATTR_LAST_MODIFIED] = mtime
+            entry_dict[ATTR_METADATA_FILE] = Path(metadata_file)
+            stories[Path(file)] = StoryState(metadata_mtime, mtime_ns, size,
+                                             Entry(entry_dict),
+                                             _decode_backstory(backstory))
+        return dirs, stories
+
+    def save(self, attributes: Iterable[str],
+             dirs: Mapping[Path, Optional[DirState]],
+             stories: Mapping[Path, Optional[StoryState]]) -> None:
+        """
+        Save the changed directory and story states. A state of None means
+        that the directory or story should be removed from the cache.
+        """
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                       ('attributes', json.dumps(sorted(attributes))))
+            db.executemany('DELETE FROM directories WHERE path = ?',
+                           [(str(path),) for path, state in dirs.items()
+                            if state is None])
+            db.executemany(
+                'INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)',
+                [(str(path), state.mtime, json.dumps(state.stories),
+                  json.dumps(state.subdirs))
+                 for path, state in dirs.items() if state is not None])
+            db.executemany('DELETE FROM stories WHERE file = ?',
+                           [(str(file),) for file, state in stories.items()
+                            if state is None])
+            db.executemany(
+                'INSERT OR REPLACE INTO stories '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(str(file), state.entry[ATTR_INDEX],
+                  str(state.entry[ATTR_METADATA_FILE]),
+                  state.metadata_mtime, _encode_metadata(state.entry),
+                  state.entry[ATTR_LAST_MODIFIED], state.mtime, state.size,
+                  state.entry[ATTR_WORDCOUNT],
+                  state.entry[ATTR_BACKSTORY_WORDCOUNT],
+                  state.entry[ATTR_BACKSTORY_PAGES],
+                  _encode_backstory(state.backstory))
+                 for file, state in stories.items() if state is not None])
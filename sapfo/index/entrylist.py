@@ -1,7 +1,6 @@
 import json
-import os
 import pickle
-import re
+from collections import OrderedDict
 from operator import attrgetter
 from pathlib import Path
 from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
@@ -11,13 +10,12 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
 from .. import declin, declin_qt
-from ..common import (CACHE_DIR, STATE_FILTER_KEY, STATE_SORT_KEY, Settings,
-                      SortBy)
-from ..taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
-                          ATTR_FILE, ATTR_INDEX, ATTR_LAST_MODIFIED,
-                          ATTR_METADATA_FILE, ATTR_TITLE, ATTR_WORDCOUNT,
-                          AttributeData, Entries, Entry, builtin_attrs,
-                          edit_entry, filter_entry)
+from ..common import STATE_FILTER_KEY, STATE_SORT_KEY, Settings, SortBy
+from ..taggedlist import (ATTR_FILE, ATTR_INDEX, ATTR_METADATA_FILE,
+                          ATTR_TITLE, AttributeData, AttrType, Entries, Entry,
+                          EntryColumns, EntryTexts, FilterPlan, FilterTiming,
+                          builtin_attrs, edit_entry, is_refinement)
+from ..tagsystem import TagIndex, TagMacros, TagVocabulary
 
 
 def calc_entry_layout(entry: Entry, visible_pos: int,
@@ -29,16 +27,30 @@ def calc_entry_layout(entry: Entry, visible_pos: int,
     return declin_qt.calc_size(entry_dict, m.sections[m.main], m, rect, 0)
 
 
+# The entry, width, gui model (its hash) and visible position (None if the
+# gui model doesn't show it) that a layout was made for
+LayoutKey = Tuple[Entry, int, int, Optional[int]]
+
+
 class EntryItem:
     def __init__(self, entry: Entry, group: declin_qt.DrawGroup,
-                 real_pos: int) -> None:
+                 real_pos: int, layout_key: Optional[LayoutKey] = None
+                 ) -> None:
         self.entry = entry
         self.group = group
+        self.layout_key = layout_key
         self.pos = real_pos
         self.visible_pos = real_pos
         self.hidden = False
 
 
+# The version of the entries and the key of the filters (see FilterPlan)
+FilterKey = Tuple[int, Tuple[Tuple[str, str], ...]]
+
+# How many filter results are remembered
+FILTER_CACHE_SIZE = 16
+
+
 class EntryList(QtWidgets.QWidget):
 
     visible_count_changed = mk_signal2(int, int)
@@ -60,11 +72,42 @@ class EntryList(QtWidgets.QWidget):
         settings.tag_colors_changed.connect(self.set_tag_colors)
         self.undostack: List[Entries] = []
         self.entry_items: List[EntryItem] = []
+        # Every tag in the entries, and the items that have each tag (by
+        # tag attribute), for running tag filters on the index
+        self.tag_vocabulary = TagVocabulary()
+        self.tag_indexes: Dict[str, TagIndex[EntryItem]] = {}
+        # The numeric attributes of the items, for running number filters
+        # without going through the entries
+        self.columns: EntryColumns[EntryItem] = EntryColumns({})
+        # The casefolded text attributes of the items, for running text
+        # filters and looking up entries by name
+        self.texts: EntryTexts[EntryItem] = EntryTexts({})
+        # The items that matched the most recently used filters. The
+        # version is bumped whenever the entries (or anything else that
+        # changes the result of a filter) change.
+        self._version = 0
+        self._filter_cache: \
+            'OrderedDict[FilterKey, FrozenSet[EntryItem]]' = OrderedDict()
+        # How long each filter took the last time the entries were filtered
+        # (empty if the result was cached)
+        self.filter_timings: List[FilterTiming] = []
+        # The version, filters and matching items of the last filtering, so
+        # that only those items have to be checked if the filters are made
+        # stricter
+        self._last_filtering: Optional[Tuple[
+            int, List[Tuple[str, str]], FrozenSet[EntryItem]]] = None
+        # Set by the index view, which reports any broken macros
+        self.tag_macros = TagMacros({})
         # Attribute data
         self.base_gui = base_gui
         self.user_gui = user_gui
         self.gui_model: declin_qt.Model
-        self.attribute_data: AttributeData
+        # The hash of the gui model's sources, and whether the layout of an
+        # entry depends on its position. Together with the entry and the
+        # width, they decide if an item's layout can be reused.
+        self._gui_hash = 0
+        self._layout_uses_pos = True
+        self.attribute_data: AttributeData = {}
         self.update_gui(recalc_and_redraw=False)
         state: Dict[str, Any]
         try:
@@ -114,10 +157,7 @@ class EntryList(QtWidgets.QWidget):
         y = 0
         width = self.width()
         for n, real_pos in sorted(self._visible_to_real_pos.items()):
-            item = self.entry_items[real_pos]
-            group = calc_entry_layout(item.entry, n, self.gui_model,
-                                      y, width)
-            item.group = group
+            group = self._layout_item(self.entry_items[real_pos], n, y, width)
             y += group.size().height()
         self._minimum_height = y
         self.updateGeometry()
@@ -136,11 +176,22 @@ class EntryList(QtWidgets.QWidget):
         except declin.common.ParsingError as e:
             print('GUI PARSING ERROR', e)
         else:
-            self.attribute_data = builtin_attrs.copy()
-            self.attribute_data.update(gui_model.attributes)
+            attribute_data = builtin_attrs.copy()
+            attribute_data.update(gui_model.attributes)
+            # There may be new tag, number or text attributes. This is also
+            # called on every resize, when they are always the same.
+            if attribute_data != self.attribute_data:
+                self.attribute_data = attribute_data
+                self._build_indexes()
             self.gui_model = declin_qt.Model(main=gui_model.main,
                                              sections=gui_model.sections,
                                              tag_colors=self.tag_colors)
+            # The model is made from these, so the layouts can be kept if
+            # they haven't changed
+            self._gui_hash = hash((self.base_gui, user_gui,
+                                   tuple(sorted(self.raw_tag_colors.items()))))
+            self._layout_uses_pos = declin_qt.uses_attribute(self.gui_model,
+                                                             'pos')
         if recalc_and_redraw:
             self.recalc_sizes()
             self.update()
@@ -160,6 +211,74 @@ class EntryList(QtWidgets.QWidget):
             self.raw_tag_colors = new_colors
             self.update_tag_colors(new_colors)
 
+    def set_tag_macros(self, tag_macros: TagMacros) -> None:
+        self.tag_macros = tag_macros
+        self._entries_changed()
+
+    def _layout_key(self, entry: Entry, pos: int, width: int) -> LayoutKey:
+        return (entry, width, self._gui_hash,
+                pos if self._layout_uses_pos else None)
+
+    def _layout_item(self, item: EntryItem, pos: int, y: int, width: int
+                     ) -> declin_qt.DrawGroup:
+        """
+        Lay out the item at y, and return its layout. If the item's last
+        layout was made with the same key, it's moved to y instead of made
+        again.
+        """
+        key = self._layout_key(item.entry, pos, width)
+        if item.layout_key == key:
+            offset = y - item.group.drawable.rect.y()
+            if offset:
+                item.group.move(0, offset)
+        else:
+            item.group = calc_entry_layout(item.entry, pos, self.gui_model,
+                                           y, width)
+            item.layout_key = key
+        return item.group
+
+    def _entries_changed(self) -> None:
+        self._version += 1
+        # Nothing with an older version can be used again
+        self._filter_cache.clear()
+
+    def _build_indexes(self) -> None:
+        self._entries_changed()
+        self.tag_vocabulary = TagVocabulary()
+        self.tag_indexes = {name: TagIndex(self.tag_vocabulary)
+                            for name, attr in self.attribute_data.items()
+                            if attr.type_ == AttrType.TAGS}
+        self.columns = EntryColumns(self.attribute_data)
+        # Titles are short enough to be worth a trigram index
+        self.texts = EntryTexts(self.attribute_data, [ATTR_TITLE])
+        for item in self.entry_items:
+            self._index_item(item, None)
+
+    def _index_item(self, item: EntryItem, old_entry: Optional[Entry]
+                    ) -> None:
+        """
+        Update the tag indexes, columns and texts after the item's entry has
+        been changed from old_entry (or the item was added, if old_entry is
+        None).
+        """
+        self._entries_changed()
+        self.columns.update(item, item.entry)
+        self.texts.update(item, item.entry)
+        for attribute, tag_index in self.tag_indexes.items():
+            old_tags = old_entry[attribute] \
+                if old_entry is not None and attribute in old_entry else ()
+            new_tags = item.entry[attribute] \
+                if attribute in item.entry else ()
+            tag_index.replace(item, old_tags, new_tags)
+
+    def _unindex_item(self, item: EntryItem) -> None:
+        self._entries_changed()
+        self.columns.remove(item)
+        self.texts.remove(item)
+        for attribute, tag_index in self.tag_indexes.items():
+            tag_index.remove(item, item.entry[attribute]
+                             if attribute in item.entry else ())
+
     @property
     def entries(self) -> Iterable[Entry]:
         return self._entries
@@ -179,8 +298,51 @@ class EntryList(QtWidgets.QWidget):
         width = self.width()
         for n, entry in enumerate(new_entries):
             group = calc_entry_layout(entry, n, self.gui_model, y, width)
-            self.entry_items.append(EntryItem(entry, group, n))
+            self.entry_items.append(EntryItem(
+                entry, group, n, self._layout_key(entry, n, width)))
             y += group.size().height()
+        self._build_indexes()
+        self.filter_()
+        self.sort()
+
+    def update_entries(self, changed_entries: Iterable[Entry],
+                       removed_files: Iterable[Path]) -> None:
+        """
+        Add or replace the changed entries (matched by their files) and
+        remove the entries of the removed files, without a full reload.
+        """
+        changed = {entry[ATTR_FILE]: entry for entry in changed_entries}
+        removed = set(removed_files)
+        modified = False
+        new_items = []
+        for item in self.entry_items:
+            file = item.entry[ATTR_FILE]
+            if file in removed:
+                self._unindex_item(item)
+                modified = True
+                continue
+            if file in changed:
+                entry = changed.pop(file)
+                if entry != item.entry:
+                    old_entry = item.entry
+                    item.entry = entry
+                    self._index_item(item, old_entry)
+                    modified = True
+            new_items.append(item)
+        width = self.width()
+        for entry in changed.values():
+            group = calc_entry_layout(entry, len(new_items),
+                                      self.gui_model, 0, width)
+            new_item = EntryItem(
+                entry, group, len(new_items),
+                self._layout_key(entry, len(new_items), width))
+            self._index_item(new_item, None)
+            new_items.append(new_item)
+            modified = True
+        if not modified:
+            return
+        self.entry_items = new_items
+        self._entries = tuple(item.entry for item in new_items)
         self.filter_()
         self.sort()
 
@@ -190,6 +352,19 @@ class EntryList(QtWidgets.QWidget):
     def visible_count(self) -> int:
         return len(self._visible_to_real_pos)
 
+    def find_visible(self, attribute: str, text: str) -> List[int]:
+        """
+        Return the visible positions of the entries whose attribute (a text
+        attribute) includes the text, ignoring case.
+        """
+        if attribute not in self.texts:
+            folded_text = text.casefold()
+            return [pos for pos, entry in enumerate(self.visible_entries)
+                    if folded_text in entry[attribute].casefold()]
+        return sorted(item.visible_pos
+                      for item in self.texts.containing(attribute, text)
+                      if not item.hidden)
+
     def sort(self) -> None:
         def getter(entry_item: EntryItem) -> Any:
             return entry_item.entry[self.sorted_by.key]
@@ -205,28 +380,53 @@ class EntryList(QtWidgets.QWidget):
             if not item.hidden:
                 self._visible_to_real_pos[pos] = n
                 item.visible_pos = pos
-                item.group = calc_entry_layout(item.entry, pos, self.gui_model,
-                                               y, width)
-                y += item.group.size().height()
+                y += self._layout_item(item, pos, y, width).size().height()
                 pos += 1
         self.update()
 
-    def filter_(self) -> None:
+    def _matching_items(self) -> FrozenSet[EntryItem]:
         filter_list = [(k, v) for k, v
                        in self.active_filters.items()
                        if v is not None]
+        plan = FilterPlan(filter_list, self.attribute_data,
+                          self.tag_macros, self.tag_vocabulary,
+                          self.tag_indexes, self.columns, self.texts)
+        key: FilterKey = (self._version, plan.key)
+        cached_items = self._filter_cache.get(key)
+        if cached_items is not None:
+            self._filter_cache.move_to_end(key)
+            self.filter_timings = []
+            self._last_filtering = (self._version, filter_list, cached_items)
+            return cached_items
+        last_filtering = self._last_filtering
+        if last_filtering is not None \
+                and last_filtering[0] == self._version \
+                and is_refinement(last_filtering[1], filter_list,
+                                  self.attribute_data, self.tag_macros):
+            # Nothing that was filtered out can match now
+            items = frozenset(plan.select(last_filtering[2],
+                                          attrgetter('entry'), narrow=True))
+        else:
+            items = frozenset(plan.select(self.entry_items,
+                                          attrgetter('entry')))
+        self.filter_timings = plan.timings
+        self._last_filtering = (self._version, filter_list, items)
+        self._filter_cache[key] = items
+        if len(self._filter_cache) > FILTER_CACHE_SIZE:
+            self._filter_cache.popitem(last=False)
+        return items
+
+    def filter_(self) -> None:
+        matching_items = self._matching_items()
         self._visible_to_real_pos.clear()
         pos = 0
         y = 0
         width = self.width()
         for n, item in enumerate(self.entry_items):
-            if filter_entry(item.entry, filter_list,
-                            self.attribute_data, self.settings.tag_macros):
+            if item in matching_items:
                 item.visible_pos = pos
                 item.hidden = False
-                item.group = calc_entry_layout(item.entry, pos,
-                                               self.gui_model, y, width)
-                y += item.group.size().height()
+                y += self._layout_item(item, pos, y, width).size().height()
                 self._visible_to_real_pos[pos] = n
                 pos += 1
             else:
@@ -240,10 +440,14 @@ class EntryList(QtWidgets.QWidget):
         if not self.undostack:
             return 0
         items = {item.entry[ATTR_INDEX]: item for item in self.entry_items}
-        undo_batch = self.undostack.pop()
+        # Entries may have been removed since the edit was made
+        undo_batch = tuple(entry for entry in self.undostack.pop()
+                           if entry[ATTR_INDEX] in items)
         for entry in undo_batch:
             item = items[entry[ATTR_INDEX]]
+            old_entry = item.entry
             item.entry = entry
+            self._index_item(item, old_entry)
         if not self.dry_run:
             write_metadata(undo_batch, self.attribute_data)
         self.sort()
@@ -259,6 +463,7 @@ class EntryList(QtWidgets.QWidget):
         if new_entry != old_entry:
             self.undostack.append((old_entry,))
             item.entry = new_entry
+            self._index_item(item, old_entry)
             if not self.dry_run:
                 write_metadata([new_entry], self.attribute_data)
             self.sort()
@@ -307,6 +512,7 @@ class EntryList(QtWidgets.QWidget):
                 old_entries.append(entry)
                 new_entries.append(new_entry)
                 item.entry = new_entry
+                self._index_item(item, entry)
 
         if old_entries:
             self.undostack.append(tuple(old_entries))
@@ -317,89 +523,6 @@ class EntryList(QtWidgets.QWidget):
         return len(old_entries)
 
 
-def get_backstory_data(file: Path, cached_data: Dict[str, Any]
-                       ) -> Tuple[int, int]:
-    root = file.with_name(file.name + '.metadir')
-    if not root.is_dir():
-        return 0, 0
-    wordcount = 0
-    pages = 0
-    for dirpath, _, filenames in os.walk(root):
-        dir_root = Path(dirpath)
-        for fname in filenames:
-            # Skip old revision files
-            if re.search(r'\.rev\d+$', fname) is not None:
-                continue
-            try:
-                words = len((dir_root / fname)
-                            .read_text().split('\n', 1)[1].split())
-            except Exception:
-                # Just ignore the file if something went wrong
-                # TODO: add something here if being verbose?
-                pass
-            else:
-                wordcount += words
-                pages += 1
-    return wordcount, pages
-
-
-def index_stories(root: Path, progress: QtWidgets.QProgressDialog,
-                  attributes: AttributeData) -> Entries:
-    progress.setLabelText('Loading cache...')
-    cache_file = CACHE_DIR / 'index.pickle'
-    if cache_file.exists():
-        cached_data = pickle.loads(cache_file.read_bytes())
-    else:
-        cache_file.parent.mkdir(parents=True, exist_ok=True)
-        cached_data = {}
-    entries = []
-    i = 0
-    progress.setLabelText('Indexing files...')
-    hits = list(os.walk(root))
-    progress.setLabelText('Reading file data...')
-    progress.setMaximum(sum(len(fnames) for _, _, fnames in hits))
-    n = 0
-    for dirpath, _, filenames in hits:
-        dir_root = Path(dirpath)
-        for fname in filenames:
-            progress.setValue(n)
-            metafile = dir_root / f'.{fname}.metadata'
-            if not metafile.exists():
-                n += 1
-                continue
-            metadata = json.loads(metafile.read_text(encoding='utf-8'))
-            entry_dict: Dict[str, Any] = {}
-            for key, value in metadata.items():
-                if key not in attributes:
-                    raise KeyError(f'Unrecognized attribute {key} '
-                                   f'in file {dir_root / fname}')
-                entry_dict[key] = attributes[key]._load_value(value)
-            entry_dict[ATTR_INDEX] = i
-            file = dir_root / fname
-            stat = file.stat()
-            if file in cached_data \
-                    and cached_data[file]['modified'] == stat.st_mtime:
-                wordcount = cached_data[file]['wordcount']
-            else:
-                wordcount = len(file.read_text().split())
-                cached_data[file] = {'modified': stat.st_mtime,
-                                     'wordcount': wordcount}
-            (entry_dict[ATTR_BACKSTORY_WORDCOUNT],
-             entry_dict[ATTR_BACKSTORY_PAGES]) = get_backstory_data(file, cached_data)
-            entry_dict[ATTR_WORDCOUNT] = wordcount
-            entry_dict[ATTR_FILE] = file
-            entry_dict[ATTR_LAST_MODIFIED] = stat.st_mtime
-            entry_dict[ATTR_METADATA_FILE] = metafile
-            entries.append(Entry(entry_dict))
-            i += 1
-            n += 1
-    progress.setMaximum(0)
-    progress.setValue(0)
-    progress.setLabelText('Saving cache...')
-    cache_file.write_bytes(pickle.dumps(cached_data))
-    return tuple(entries)
-
-
 def write_metadata(entries: Iterable[Entry], attributes: AttributeData) -> None:
     for entry in entries:
         metadata = {
@@ -0,0 +1,690 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from itertools import islice
+from operator import attrgetter
+from pathlib import Path
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, Protocol, Set, Tuple)
+
+from ..common import CACHE_DIR
+from ..taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
+                          ATTR_FILE, ATTR_INDEX, ATTR_LAST_MODIFIED,
+                          ATTR_METADATA_FILE, ATTR_WORDCOUNT, AttributeData,
+                          Entries, Entry)
+from .cache import (BackstoryDirState, BackstoryState, DirState, IndexCache,
+                    PageState, StoryState)
+from .wordcount import count_words, count_words_batch
+
+
+class Progress(Protocol):
+    """
+    The parts of QProgressDialog that the indexing functions use.
+    """
+    def setLabelText(self, text: str) -> None:
+        ...
+
+    def setMaximum(self, maximum: int) -> None:
+        ...
+
+    def setValue(self, progress: int) -> None:
+        ...
+
+    def wasCanceled(self) -> bool:
+        ...
+
+
+class IndexingCanceled(Exception):
+    pass
+
+
+# Timestamps are coarse, so a file can be changed again without its mtime
+# changing if that happens right after it was read. Anything modified this
+# recently (in nanoseconds) is therefore not trusted to be unchanged later.
+_RACY_MTIME_NS = 2_000_000_000
+
+
+def _trusted_mtime(mtime_ns: int) -> int:
+    if time.time_ns() - mtime_ns < _RACY_MTIME_NS:
+        return -1
+    return mtime_ns
+
+
+def _list_dir(dir_root: Path
+              ) -> Optional[Tuple[List['os.DirEntry[str]'], Set[str], List[str]]]:
+    """
+    Return the sorted non-directory entries of a directory, the names of
+    all of its subdirectories and the names of the subdirectories that
+    should be descended into (ie. the ones that aren't symlinks).
+
+    Return None if the directory can't be read.
+    """
+    try:
+        with os.scandir(dir_root) as it:
+            dir_entries = sorted(it, key=attrgetter('name'))
+    except OSError:
+        return None
+    files = []
+    dirnames = set()
+    subdirs = []
+    for dir_entry in dir_entries:
+        try:
+            is_dir = dir_entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(dir_entry)
+            continue
+        dirnames.add(dir_entry.name)
+        if not dir_entry.is_symlink():
+            subdirs.append(dir_entry.name)
+    return files, dirnames, subdirs
+
+
+class StoryFile(NamedTuple):
+    file: Path
+    metadata_file: Path
+    stat: os.stat_result
+    has_metadir: bool
+
+
+def _scan_stories(dir_root: Path, known_state: Optional[DirState]
+                  ) -> Optional[Tuple[DirState, List[StoryFile]]]:
+    """
+    Return the state of a directory and the stories directly in it, or None
+    if the directory can't be read.
+
+    The stories are paired with their metadata files (and backstory
+    directories) by name lookups in the directory listing, so no extra
+    file system calls are made for files without metadata.
+
+    If the directory's mtime is the same as in known_state, it's not listed
+    again, since no files can have been added, removed or renamed in it.
+    """
+    try:
+        dir_mtime = os.stat(dir_root).st_mtime_ns
+    except OSError:
+        return None
+    story_files = []
+    if known_state is not None and known_state.mtime == dir_mtime:
+        for name, has_metadir in known_state.stories:
+            file = dir_root / name
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            story_files.append(StoryFile(file, dir_root / f'.{name}.metadata',
+                                         stat, has_metadir))
+        return known_state, story_files
+    listing = _list_dir(dir_root)
+    if listing is None:
+        return None
+    files, dirnames, subdirs = listing
+    names = {dir_entry.name for dir_entry in files}
+    stories = []
+    metadirs = set()
+    for dir_entry in files:
+        metafile_name = f'.{dir_entry.name}.metadata'
+        if metafile_name not in names:
+            continue
+        metadir_name = f'{dir_entry.name}.metadir'
+        has_metadir = metadir_name in dirnames
+        if has_metadir:
+            metadirs.add(metadir_name)
+        stories.append((dir_entry.name, has_metadir))
+        try:
+            stat = dir_entry.stat()
+        except OSError:
+            continue
+        story_files.append(StoryFile(dir_root / dir_entry.name,
+                                     dir_root / metafile_name, stat,
+                                     has_metadir))
+    # Backstory directories are read along with their stories and are not
+    # searched for stories themselves
+    state = DirState(_trusted_mtime(dir_mtime), tuple(stories),
+                     tuple(name for name in subdirs if name not in metadirs))
+    return state, story_files
+
+
+def walk_stories(root: Path, known_dirs: Optional[Dict[Path, DirState]] = None,
+                 scanned_dirs: Optional[Dict[Path, DirState]] = None
+                 ) -> Iterator[StoryFile]:
+    """
+    Yield all stories under root that have a metadata file.
+
+    Directories that haven't changed since they were recorded in known_dirs
+    are not listed again. The state of every directory that was visited is
+    added to scanned_dirs.
+    """
+    if known_dirs is None:
+        known_dirs = {}
+    stack = [root]
+    while stack:
+        dir_root = stack.pop()
+        scan = _scan_stories(dir_root, known_dirs.get(dir_root))
+        if scan is None:
+            continue
+        state, story_files = scan
+        yield from story_files
+        if scanned_dirs is not None:
+            scanned_dirs[dir_root] = state
+        # Reversed so that the directories are popped in alphabetical order
+        stack.extend(dir_root / name for name in reversed(state.subdirs))
+
+
+def _count_page(page: Path) -> Optional[int]:
+    try:
+        # The first line is the page's metadata
+        return count_words(page, skip_first_line=True)
+    except Exception:
+        # Just ignore the file if something went wrong
+        # TODO: add something here if being verbose?
+        return None
+
+
+def _scan_backstory_dir(dir_root: Path,
+                        known_state: Optional[BackstoryDirState],
+                        count: Callable[[Path], Optional[int]]
+                        ) -> Optional[BackstoryDirState]:
+    """
+    Return the state of a directory in a backstory directory, or None if
+    the directory can't be read.
+
+    If the directory's mtime is the same as in known_state, it's not listed
+    again. Only the pages whose mtime or size have changed are counted again,
+    using count.
+    """
+    try:
+        dir_mtime = os.stat(dir_root).st_mtime_ns
+    except OSError:
+        return None
+    if known_state is not None and known_state.mtime == dir_mtime:
+        names: Iterable[str] = known_state.pages
+        subdirs: Iterable[str] = known_state.subdirs
+    else:
+        listing = _list_dir(dir_root)
+        if listing is None:
+            return None
+        files, _, subdirs = listing
+        names = [dir_entry.name for dir_entry in files]
+    known_pages = known_state.pages if known_state is not None else {}
+    pages = {}
+    for name in names:
+        # Skip old revision files
+        if re.search(r'\.rev\d+$', name) is not None:
+            continue
+        page = dir_root / name
+        try:
+            stat = page.stat()
+        except OSError:
+            continue
+        known_page = known_pages.get(name)
+        if known_page is not None and known_page.mtime == stat.st_mtime_ns \
+                and known_page.size == stat.st_size:
+            words = known_page.words
+        else:
+            words = count(page)
+        pages[name] = PageState(_trusted_mtime(stat.st_mtime_ns),
+                                stat.st_size, words)
+    return BackstoryDirState(_trusted_mtime(dir_mtime), pages, tuple(subdirs))
+
+
+def get_backstory_data(file: Path, cached_data: BackstoryState,
+                       count: Callable[[Path], Optional[int]] = _count_page
+                       ) -> Tuple[int, int, BackstoryState]:
+    """
+    Return the total word count and the number of pages in a story's
+    backstory directory, along with its new state.
+
+    cached_data is the state from the last time the backstory was read,
+    and only what has changed since then is read again. count is used to
+    count the words of a page, and should return None if it can't be read.
+    """
+    root = file.with_name(file.name + '.metadir')
+    wordcount = 0
+    pages = 0
+    state: BackstoryState = {}
+    stack = [root]
+    while stack:
+        dir_root = stack.pop()
+        dir_state = _scan_backstory_dir(dir_root, cached_data.get(dir_root),
+                                        count)
+        if dir_state is None:
+            continue
+        state[dir_root] = dir_state
+        for page in dir_state.pages.values():
+            if page.words is not None:
+                wordcount += page.words
+                pages += 1
+        # Reversed so that the directories are popped in alphabetical order
+        stack.extend(dir_root / name for name in reversed(dir_state.subdirs))
+    return wordcount, pages, state
+
+
+def _is_counted(story: StoryFile, previous: Optional[StoryState]) -> bool:
+    return previous is not None \
+        and previous.mtime == story.stat.st_mtime_ns \
+        and previous.size == story.stat.st_size
+
+
+def _has_changed(story: StoryFile, previous: Optional[StoryState]) -> bool:
+    """
+    Return True if the story's file or metadata file has changed since it
+    was read as previous, or if it got or lost its backstory directory.
+    """
+    if not _is_counted(story, previous):
+        return True
+    assert previous is not None
+    try:
+        metadata_mtime = story.metadata_file.stat().st_mtime_ns
+    except OSError:
+        return True
+    return metadata_mtime != previous.metadata_mtime \
+        or story.has_metadir != bool(previous.backstory)
+
+
+def _read_story(index: int, story: StoryFile, previous: Optional[StoryState],
+                attributes: AttributeData,
+                counts: Mapping[Path, Optional[int]] = {}) -> StoryState:
+    """
+    Read the metadata, stats and word counts of a single story.
+
+    If the story was indexed before (previous), only the parts that have
+    changed since then are read again, and the previous entry is reused
+    as-is if nothing changed at all.
+
+    Word counts of the story file and backstory pages that are in counts
+    (None meaning the file couldn't be counted) are used instead of counting
+    the words again.
+    """
+    file = story.file
+    metafile = story.metadata_file
+    metadata_mtime = metafile.stat().st_mtime_ns
+    stat = story.stat
+    if previous is not None and _is_counted(story, previous):
+        wordcount = previous.entry[ATTR_WORDCOUNT]
+    else:
+        precounted = counts.get(file)
+        # Count it again if it failed, to get the actual error
+        wordcount = (precounted if precounted is not None
+                     else count_words(file))
+
+    def count_page(page: Path) -> Optional[int]:
+        if page in counts:
+            return counts[page]
+        return _count_page(page)
+
+    if story.has_metadir:
+        backstory_wordcount, backstory_pages, backstory = get_backstory_data(
+            file, previous.backstory if previous is not None else {},
+            count_page)
+    else:
+        backstory_wordcount, backstory_pages, backstory = 0, 0, {}
+    file_data = {
+        ATTR_INDEX: index,
+        ATTR_BACKSTORY_WORDCOUNT: backstory_wordcount,
+        ATTR_BACKSTORY_PAGES: backstory_pages,
+        ATTR_WORDCOUNT: wordcount,
+        ATTR_FILE: file,
+        ATTR_LAST_MODIFIED: stat.st_mtime,
+        ATTR_METADATA_FILE: metafile,
+    }
+    if previous is not None and previous.metadata_mtime == metadata_mtime:
+        entry = previous.entry
+        changed = {key: value for key, value in file_data.items()
+                   if entry[key] != value}
+        if changed:
+            entry = entry.replace(**changed)
+    else:
+        metadata = json.loads(metafile.read_text(encoding='utf-8'))
+        entry_dict: Dict[str, Any] = {}
+        for key, value in metadata.items():
+            if key not in attributes:
+                raise KeyError(f'Unrecognized attribute {key} '
+                               f'in file {file}')
+            entry_dict[key] = attributes[key]._load_value(value)
+        entry_dict.update(file_data)
+        entry = Entry(entry_dict)
+    return StoryState(_trusted_mtime(metadata_mtime),
+                      _trusted_mtime(stat.st_mtime_ns), stat.st_size, entry,
+                      backstory)
+
+
+# Starting worker processes takes a while, so it's only worth it if there
+# are at least this many files to count
+_MIN_PROCESS_JOBS = 500
+# How many files to count in one task in a worker process
+_PROCESS_BATCH_SIZE = 64
+
+
+def _count_in_processes(stories: List[StoryFile],
+                        known_stories: Mapping[Path, StoryState],
+                        processes: int, progress: Progress
+                        ) -> Dict[Path, Optional[int]]:
+    """
+    Count the words in the story files and backstory pages that aren't
+    counted yet, using a pool of processes.
+
+    Only stories that weren't indexed before have their backstories
+    searched for pages to count, since the pages of other stories are most
+    likely counted already. If there are too few files to count, nothing is
+    counted and they are left to be counted when the stories are read.
+    """
+    jobs: List[Tuple[Path, bool]] = []
+
+    def add_page(page: Path) -> None:
+        jobs.append((page, True))
+
+    for story in stories:
+        previous = known_stories.get(story.file)
+        if not _is_counted(story, previous):
+            jobs.append((story.file, False))
+        if previous is None and story.has_metadir:
+            get_backstory_data(story.file, {}, add_page)
+    if len(jobs) < _MIN_PROCESS_JOBS:
+        return {}
+    progress.setLabelText('Counting words...')
+    progress.setMaximum(len(jobs))
+    batches = [jobs[i:i + _PROCESS_BATCH_SIZE]
+               for i in range(0, len(jobs), _PROCESS_BATCH_SIZE)]
+    counts: Dict[Path, Optional[int]] = {}
+    # Forking a process with Qt's threads running isn't safe
+    context = multiprocessing.get_context('spawn')
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+    # Only a few batches are queued at a time, so that there's little left
+    # to wait for (or cancel) if the indexing is canceled
+    queued: Dict[Future[List[Optional[int]]], List[Tuple[Path, bool]]] = {}
+    remaining = iter(batches)
+    try:
+        while True:
+            for batch in islice(remaining, processes * 2 - len(queued)):
+                queued[executor.submit(count_words_batch, batch)] = batch
+            if not queued:
+                break
+            done, _ = wait(queued, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = queued.pop(future)
+                counts.update((file, words) for (file, _), words
+                              in zip(batch, future.result()))
+            progress.setValue(len(counts))
+            if progress.wasCanceled():
+                raise IndexingCanceled()
+    except BaseException:
+        # Don't wait for the queued batches. The ones that are already being
+        # counted are left to finish in the background.
+        for future in queued:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+    return counts
+
+
+class Changes(NamedTuple):
+    # New or changed entries
+    entries: List[Entry]
+    # The files of the stories that don't exist anymore
+    removed: List[Path]
+    errors: List[str]
+
+
+class StoryIndex:
+    """
+    Index of the stories under a root directory.
+
+    The index remembers the state of every directory and story from the
+    last update (also between runs, via a database in the cache directory),
+    so an update only re-reads the directories and files that have changed
+    and reuses the previous entries for everything else.
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR) -> None:
+        self.cache = IndexCache(cache_dir / 'index.sqlite')
+        self._loaded = False
+        self._attributes: Tuple[str, ...] = ()
+        self._dirs: Dict[Path, DirState] = {}
+        self._stories: Dict[Path, StoryState] = {}
+
+    def _load(self, attributes: AttributeData) -> None:
+        if not self._loaded:
+            self._dirs, self._stories = self.cache.load(attributes)
+            self._attributes = tuple(sorted(attributes))
+            self._loaded = True
+
+    def cached_entries(self, root: Path, attributes: AttributeData
+                       ) -> Entries:
+        """
+        Return the entries under root from the last update, without touching
+        any of the stories' files.
+        """
+        self._load(attributes)
+        return tuple(state.entry for file, state in self._stories.items()
+                     if root in file.parents)
+
+    def update(self, root: Path, progress: Progress,
+               attributes: AttributeData, workers: int = 1,
+               processes: int = 0,
+               on_read: Optional[Callable[[Entry], None]] = None) -> Entries:
+        """
+        Return all stories under root as entries.
+
+        Every entry is also passed to on_read (if specified) as soon as it's
+        read. IndexingCanceled is raised if the progress is canceled, and
+        the index is then left as it was before the update.
+
+        If workers is more than 1, the per-file work is spread out over that
+        many threads. The entries are still returned (and indexed) in the
+        same order as when indexing sequentially.
+
+        If processes is more than 0 and there are a lot of files whose words
+        haven't been counted before, they are counted in that many
+        processes first.
+        """
+        progress.setLabelText('Loading cache...')
+        self._load(attributes)
+        progress.setLabelText('Indexing files...')
+        scanned_dirs: Dict[Path, DirState] = {}
+        stories = list(walk_stories(root, self._dirs, scanned_dirs))
+        # Entries loaded with other attributes may have been loaded wrong
+        attribute_names = tuple(sorted(attributes))
+        known_stories = (self._stories if attribute_names == self._attributes
+                         else {})
+        counts: Dict[Path, Optional[int]] = {}
+        if processes > 0:
+            counts = _count_in_processes(stories, known_stories, processes,
+                                         progress)
+        progress.setLabelText('Reading file data...')
+        progress.setMaximum(len(stories))
+
+        canceled = False
+
+        def read(job: Tuple[int, StoryFile]) -> StoryState:
+            if canceled:
+                # Don't let the remaining jobs in the pool do any work
+                raise IndexingCanceled()
+            index, story = job
+            return _read_story(index, story, known_stories.get(story.file),
+                               attributes, counts)
+
+        def collect(results: Iterable[StoryState]) -> List[StoryState]:
+            nonlocal canceled
+            states = []
+            for i, state in enumerate(results):
+                if progress.wasCanceled():
+                    canceled = True
+                    raise IndexingCanceled()
+                progress.setValue(i)
+                if on_read is not None:
+                    on_read(state.entry)
+                states.append(state)
+            return states
+
+        if workers > 1 and len(stories) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # map() yields the results in the order of the input,
+                # no matter which worker finishes first
+                states = collect(executor.map(read, enumerate(stories)))
+        else:
+            states = collect(map(read, enumerate(stories)))
+        new_stories = {state.entry[ATTR_FILE]: state for state in states}
+        changed_dirs: Dict[Path, Optional[DirState]] = {
+            path: state for path, state in scanned_dirs.items()
+            if self._dirs.get(path) != state
+        }
+        changed_dirs.update((path, None) for path in self._dirs
+                            if path not in scanned_dirs)
+        changed_stories: Dict[Path, Optional[StoryState]] = {
+            file: state for file, state in new_stories.items()
+            if known_stories.get(file) != state
+        }
+        changed_stories.update((file, None) for file in self._stories
+                               if file not in new_stories)
+        self._attributes = attribute_names
+        self._dirs = scanned_dirs
+        self._stories = new_stories
+        progress.setMaximum(0)
+        progress.setValue(0)
+        progress.setLabelText('Saving cache...')
+        self.cache.save(attribute_names, changed_dirs, changed_stories)
+        return tuple(state.entry for state in states)
+
+    def watched_paths(self) -> List[Path]:
+        """
+        Return the paths that have to be watched to notice all changes to
+        the stories: every directory with stories in it and every directory
+        in the backstory directories.
+
+        Only directories are watched, since watching every file would run
+        out of inotify watches (or file descriptors) on large libraries.
+        This means that a file that is written in place, without adding,
+        removing, renaming or changing the attributes of any file in its
+        directory, isn't noticed until the next reload. (Most editors save
+        to a new file and rename it, which is noticed.)
+        """
+        paths = list(self._dirs)
+        for story_state in self._stories.values():
+            paths.extend(story_state.backstory)
+        return paths
+
+    def _story_of(self, path: Path) -> Optional[Path]:
+        """
+        Return the file of the story that path (a story file, metadata file
+        or anything in a backstory directory) belongs to, if any.
+        """
+        if path in self._stories:
+            return path
+        name = path.name
+        if name.startswith('.') and name.endswith('.metadata'):
+            story = path.with_name(name[1:-len('.metadata')])
+            if story in self._stories:
+                return story
+        for parent in (path, *path.parents):
+            if parent.name.endswith('.metadir'):
+                story = parent.with_name(parent.name[:-len('.metadir')])
+                if story in self._stories:
+                    return story
+        return None
+
+    def refresh(self, paths: Iterable[Path], attributes: AttributeData
+                ) -> Changes:
+        """
+        Re-read only the stories affected by changes to the specified paths
+        (directories, story files, metadata files or backstory files).
+
+        Changed directories are listed again to find added and removed
+        stories, and only the stories in them whose files have changed
+        (going by their mtimes and sizes) are read again. A changed file
+        only re-reads its own story.
+        """
+        self._load(attributes)
+        to_read: Dict[Path, StoryFile] = {}
+        changed_dirs: Dict[Path, Optional[DirState]] = {}
+        removed: Set[Path] = set()
+        errors: List[str] = []
+
+        def forget_dir(dir_root: Path) -> None:
+            dir_state = self._dirs.pop(dir_root, None)
+            if dir_state is not None:
+                changed_dirs[dir_root] = None
+                removed.update(dir_root / name
+                               for name, _ in dir_state.stories)
+                for name in dir_state.subdirs:
+                    forget_dir(dir_root / name)
+
+        for path in sorted(set(paths)):
+            # A change in a backstory directory only affects its story,
+            # even if the directory was recorded as a story directory
+            file = self._story_of(path)
+            if file is None and path in self._dirs:
+                old_state = self._dirs[path]
+                scan = _scan_stories(path, None)
+                if scan is None:
+                    forget_dir(path)
+                    continue
+                dir_state, story_files = scan
+                self._dirs[path] = changed_dirs[path] = dir_state
+                to_read.update((story.file, story) for story in story_files
+                               if _has_changed(story,
+                                               self._stories.get(story.file)))
+                names = {name for name, _ in dir_state.stories}
+                removed.update(path / name for name, _ in old_state.stories
+                               if name not in names)
+                for name in set(old_state.subdirs) - set(dir_state.subdirs):
+                    forget_dir(path / name)
+                for name in sorted(set(dir_state.subdirs)
+                                   - set(old_state.subdirs)):
+                    new_dirs: Dict[Path, DirState] = {}
+                    to_read.update((story.file, story) for story
+                                   in walk_stories(path / name, None,
+                                                   new_dirs))
+                    self._dirs.update(new_dirs)
+                    changed_dirs.update(new_dirs)
+            else:
+                if file is None or file in to_read:
+                    continue
+                try:
+                    stat = file.stat()
+                except OSError:
+                    removed.add(file)
+                    continue
+                metadir = file.with_name(file.name + '.metadir')
+                to_read[file] = StoryFile(
+                    file, file.with_name(f'.{file.name}.metadata'),
+                    stat, metadir.is_dir())
+        next_index = max((state.entry[ATTR_INDEX]
+                          for state in self._stories.values()),
+                         default=-1) + 1
+        entries = []
+        changed_stories: Dict[Path, Optional[StoryState]] = {}
+        for file, story in to_read.items():
+            previous = self._stories.get(file)
+            if previous is not None:
+                index = previous.entry[ATTR_INDEX]
+            else:
+                index = next_index
+                next_index += 1
+            try:
+                story_state = _read_story(index, story, previous, attributes)
+            except FileNotFoundError:
+                # The metadata file is gone, so it's not a story anymore
+                removed.add(file)
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                errors.append(f'Failed to read {file}: {e}')
+                continue
+            removed.discard(file)
+            self._stories[file] = story_state
+            if story_state != previous:
+                changed_stories[file] = story_state
+            if previous is None or story_state.entry != previous.entry:
+                entries.append(story_state.entry)
+        removed_files = sorted(file for file in removed
+                               if self._stories.pop(file, None) is not None)
+        changed_stories.update((file, None) for file in removed_files)
+        if changed_dirs or changed_stories:
+            self.cache.save(self._attributes, changed_dirs, changed_stories)
+        return Changes(entries, removed_files, errors)
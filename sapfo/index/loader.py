@@ -0,0 +1,145 @@
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from libsyntyche.widgets import mk_signal0, mk_signal1, mk_signal2
+from PyQt5 import QtCore
+
+from ..taggedlist import AttributeData, Entry
+from .indexing import IndexingCanceled, StoryIndex
+
+
+class IndexLoader(QtCore.QThread):
+    """
+    Update a StoryIndex in a background thread.
+
+    The entries are sent in batches (entries_read) while they are read, and
+    finally all of them at once (loaded). The first batches are sent quickly
+    so that something shows up right away, and then less and less often, so
+    that updating the list with the new entries doesn't take over.
+
+    Progress updates are sent at most once every interval seconds.
+    """
+    label_changed = mk_signal1(str)
+    maximum_changed = mk_signal1(int)
+    value_changed = mk_signal1(int)
+    entries_read = mk_signal1(tuple)
+    loaded = mk_signal1(tuple)
+    canceled = mk_signal0()
+    failed = mk_signal1(str)
+
+    # Emitted from the worker thread with the update they belong to and
+    # the name and argument of the public signal to emit
+    _event = mk_signal2(int, tuple)
+    _done = mk_signal2(int, object)
+
+    def __init__(self, story_index: StoryIndex, parent: QtCore.QObject,
+                 interval: float = 0.1, max_batch_interval: float = 2) -> None:
+        super().__init__(parent)
+        self.story_index = story_index
+        self.interval = interval
+        self.max_batch_interval = max_batch_interval
+        self._generation = 0
+        self._canceled = False
+        self._args: Optional[Tuple[Path, AttributeData, int, int]] = None
+        self._pending: List[Entry] = []
+        self._last_value = 0.0
+        self._last_batch = 0.0
+        self._batch_interval = interval
+        self._event.connect(self._relay_event)
+        self._done.connect(self._relay_done)
+
+    def load(self, root: Path, attributes: AttributeData, workers: int = 1,
+             processes: int = 0) -> None:
+        """
+        Start updating the index, stopping the current update if there
+        is one.
+        """
+        self.stop()
+        self._generation += 1
+        self._canceled = False
+        self._args = (root, attributes, workers, processes)
+        self.start()
+
+    def cancel(self) -> None:
+        """
+        Cancel the current update, if any. canceled is emitted once it has
+        stopped.
+        """
+        self._canceled = True
+
+    def stop(self) -> None:
+        """
+        Cancel the current update (if any) and wait for it to stop.
+        Nothing more is sent from it after this.
+        """
+        if self.isRunning():
+            self._canceled = True
+            self.wait()
+            # Ignore anything that was sent before it stopped
+            self._generation += 1
+
+    def run(self) -> None:
+        assert self._args is not None
+        root, attributes, workers, processes = self._args
+        generation = self._generation
+        self._pending = []
+        self._last_value = self._last_batch = time.monotonic()
+        self._batch_interval = self.interval
+        try:
+            entries = self.story_index.update(
+                root, self, attributes, workers=workers,
+                processes=processes, on_read=self._add_entry)
+        except IndexingCanceled:
+            self._done.emit(generation, None)
+        except Exception as e:
+            self._done.emit(generation, e)
+        else:
+            self._send_batch()
+            self._done.emit(generation, entries)
+
+    def _add_entry(self, entry: Entry) -> None:
+        self._pending.append(entry)
+        if time.monotonic() - self._last_batch >= self._batch_interval:
+            self._send_batch()
+            self._batch_interval = min(self._batch_interval * 2,
+                                       self.max_batch_interval)
+
+    def _send_batch(self) -> None:
+        if self._pending:
+            self._event.emit(self._generation,
+                             ('entries_read', tuple(self._pending)))
+            self._pending = []
+        self._last_batch = time.monotonic()
+
+    def _relay_event(self, generation: int, event: Tuple[str, Any]) -> None:
+        if generation == self._generation:
+            signal_name, arg = event
+            getattr(self, signal_name).emit(arg)
+
+    def _relay_done(self, generation: int, result: Any) -> None:
+        if generation != self._generation:
+            return
+        if result is None:
+            self.canceled.emit()
+        elif isinstance(result, Exception):
+            self.failed.emit(f'Indexing failed: {result!r}')
+        else:
+            self.loaded.emit(result)
+
+    # Progress protocol, called from the worker thread
+
+    def setLabelText(self, text: str) -> None:
+        self._event.emit(self._generation, ('label_changed', text))
+
+    def setMaximum(self, maximum: int) -> None:
+        self._event.emit(self._generation, ('maximum_changed', maximum))
+
+    def setValue(self, progress: int) -> None:
+        now = time.monotonic()
+        if progress == 0 or now - self._last_value >= self.interval:
+            self._last_value = now
+            self._event.emit(self._generation, ('value_changed', progress))
+
+    def wasCanceled(self) -> bool:
+        return self._canceled
@@ -0,0 +1,47 @@
+from pathlib import Path
+from typing import Iterable, Set
+
+from libsyntyche.widgets import mk_signal1
+from PyQt5 import QtCore
+
+
+class StoryWatcher(QtCore.QObject):
+    """
+    Watch files and directories and report the ones that changed.
+
+    Events are coalesced and only reported once nothing has changed for
+    delay milliseconds, so eg. an editor saving a file in several steps
+    only results in one report.
+    """
+    changed = mk_signal1(list)
+
+    def __init__(self, parent: QtCore.QObject, delay: int = 300) -> None:
+        super().__init__(parent)
+        self._watcher = QtCore.QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self._add_pending)
+        self._watcher.directoryChanged.connect(self._add_pending)
+        self._pending: Set[str] = set()
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self._emit_pending)
+
+    def set_paths(self, paths: Iterable[Path]) -> None:
+        new_paths = {str(path) for path in paths}
+        old_paths = (set(self._watcher.files())
+                     | set(self._watcher.directories()))
+        removed = old_paths - new_paths
+        added = new_paths - old_paths
+        if removed:
+            self._watcher.removePaths(sorted(removed))
+        if added:
+            self._watcher.addPaths(sorted(added))
+
+    def _add_pending(self, path: str) -> None:
+        self._pending.add(path)
+        self._timer.start()
+
+    def _emit_pending(self) -> None:
+        paths = sorted(self._pending)
+        self._pending.clear()
+        self.changed.emit(paths)
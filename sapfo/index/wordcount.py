@@ -0,0 +1,90 @@
+import codecs
+import mmap
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+# How many bytes are decoded and counted at a time. Splitting a chunk is a lot
+# faster than matching its words one by one with a regex, and this keeps the
+# temporary list of words small.
+CHUNK_SIZE = 1 << 16
+
+
+def count_words(file: Path, skip_first_line: bool = False,
+                chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Return the number of whitespace-separated words in a UTF-8 file.
+
+    The file is memory-mapped and decoded one chunk at a time, so the memory
+    used doesn't depend on the size of the file. The result is the same as
+    len(file.read_text(encoding='utf-8').split()). Unlike read_text()
+    without an encoding, the file is always decoded as strict UTF-8 rather
+    than with the locale's encoding, so a file in any other encoding raises
+    a UnicodeDecodeError.
+
+    If skip_first_line is true, the first line (ending in \n, \r\n or \r,
+    like with universal newlines) is not counted, and a ValueError is
+    raised if the file doesn't have more than one line.
+    """
+    with file.open('rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            if skip_first_line:
+                raise ValueError(f'{file} has no first line')
+            return 0
+    with data:
+        start = 0
+        if skip_first_line:
+            # A newline byte is never part of a multibyte UTF-8 character.
+            # If the line ends in \r\n, the \n is left in the rest of the
+            # file, where it's only whitespace.
+            line_end = data.find(b'\n')
+            # Only look for \r before the first \n, to not search through
+            # the whole file for one
+            cr = data.find(b'\r', 0, len(data) if line_end == -1
+                           else line_end)
+            if cr != -1:
+                line_end = cr
+            if line_end == -1:
+                raise ValueError(f'{file} has no first line')
+            start = line_end + 1
+        return _count_chunks(data, start, len(data), chunk_size)
+
+
+def count_words_batch(jobs: Sequence[Tuple[Path, bool]]
+                      ) -> List[Optional[int]]:
+    """
+    Count the words in several files, each given as a (file, skip_first_line)
+    pair. Files that can't be counted get None instead of a count.
+
+    Meant to be run as one task in a process pool, so that many small files
+    are sent to the worker process at once.
+    """
+    counts: List[Optional[int]] = []
+    for file, skip_first_line in jobs:
+        try:
+            counts.append(count_words(file, skip_first_line))
+        except Exception:
+            counts.append(None)
+    return counts
+
+
+def _count_chunks(data: mmap.mmap, start: int, end: int,
+                  chunk_size: int) -> int:
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    words = 0
+    # Whether the previous chunk ended in the middle of a word
+    in_word = False
+    for pos in range(start, end, chunk_size):
+        chunk = decoder.decode(data[pos:min(pos + chunk_size, end)])
+        if not chunk:
+            # Only part of a multibyte character, the rest is in the next chunk
+            continue
+        words += len(chunk.split())
+        # Don't count a word that is split between two chunks twice
+        if in_word and not chunk[0].isspace():
+            words -= 1
+        in_word = not chunk[-1].isspace()
+    decoder.decode(b'', final=True)
+    return words
@@ -6,7 +6,7 @@ import subprocess
 from collections import Counter
 from operator import itemgetter
 from pathlib import Path
-from typing import Dict, List, Match, Optional, Tuple
+from typing import Dict, Iterable, List, Match, Optional, Set, Tuple
 
 from libsyntyche.cli import ArgumentRules, AutocompletionPattern, Command
 from libsyntyche.terminal import MessageTray
@@ -19,13 +19,16 @@ from . import tagsystem
 from .common import (LOCAL_DIR, STATE_FILTER_KEY, STATE_SORT_KEY,
                      ActiveFilters, Settings, SortBy)
 from .declarative import Stretch, hbox, label, vbox
-from .index.entrylist import EntryList, index_stories
+from .index.entrylist import EntryList
+from .index.indexing import StoryIndex
+from .index.loader import IndexLoader
 from .index.taginfolist import TagInfoList
 from .index.terminal import Terminal
+from .index.watcher import StoryWatcher
 from .taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
                          ATTR_FILE, ATTR_TAGS, ATTR_TITLE, ATTR_WORDCOUNT,
                          NONEMPTY_SEARCH, AttributeData, AttrParseError,
-                         AttrType, Entry)
+                         AttrType, Entries, Entry)
 
 
 class IconWidget(QtSvg.QSvgWidget):
@@ -166,6 +169,19 @@ class IndexView(QtWidgets.QWidget):
         self.progress = QtWidgets.QProgressDialog(self)
         self.progress.setModal(True)
         self.progress.setAutoReset(False)
+        self.story_index = StoryIndex()
+        self.loader = IndexLoader(self.story_index, self)
+        self.loader.label_changed.connect(self.progress.setLabelText)
+        self.loader.maximum_changed.connect(self.progress.setMaximum)
+        self.loader.value_changed.connect(self.progress.setValue)
+        self.loader.entries_read.connect(self.show_entries)
+        self.loader.loaded.connect(self.finish_reload)
+        self.loader.canceled.connect(self.cancel_reload)
+        self.loader.failed.connect(self.fail_reload)
+        self.progress.canceled.connect(self.loader.cancel)
+        self.pending_changed_paths: Set[str] = set()
+        self.watcher = StoryWatcher(self)
+        self.watcher.changed.connect(self.update_changed_paths)
         # Hotkeys
         hotkeypairs = (
             ('reload', self.reload_view),
@@ -182,6 +198,9 @@ class IndexView(QtWidgets.QWidget):
         self.message_tray = MessageTray(self)
         self.terminal.show_message.connect(self.message_tray.add_message)
         self.status_bar.moved.connect(self.adjust_tray)
+        # Tag macros
+        self.update_tag_macros(settings.tag_macros)
+        settings.tag_macros_changed.connect(self.update_tag_macros)
 
     @property
     def attribute_data(self) -> AttributeData:
@@ -271,6 +290,8 @@ class IndexView(QtWidgets.QWidget):
             short_name='f',
             arg_help=(
                 ('', 'List the active filters.'),
+                ('?', 'Show how long each filter took the last time the '
+                      'entries were filtered, in the order they were run.'),
                 ('-', 'Reset all filters.'),
                 (f'[{filter_abbrevs}]-', 'Reset the specified filter.'),
                 (f'[{filter_abbrevs}]',
@@ -469,6 +490,12 @@ class IndexView(QtWidgets.QWidget):
         for key, shortcut in self.hotkeys.items():
             shortcut.setKey(QtGui.QKeySequence(hotkeys[key]))
 
+    def update_tag_macros(self, tag_macros: Dict[str, str]) -> None:
+        compiled_macros = tagsystem.TagMacros(tag_macros)
+        for name, error in sorted(compiled_macros.errors.items()):
+            self.error(f'[Tag macro @{name}] {error}')
+        self.entry_view.set_tag_macros(compiled_macros)
+
     def zoom_in(self) -> None:
         pass
 
@@ -486,22 +513,92 @@ class IndexView(QtWidgets.QWidget):
         Is also the method that generates the entrylist the first time.
         So don't look for a init_everything method/function or anything, kay?
         """
+        if self.entry_view.count() == 0:
+            # Show the stories from the last run right away and check them
+            # against the files once the window is up
+            cached_entries = self.story_index.cached_entries(
+                self.rootpath, self.attribute_data)
+            if cached_entries:
+                self.set_entries(cached_entries)
+                QtCore.QTimer.singleShot(0, self.reload_view)
+                return
         self.progress.setLabelText('Loading index...')
         self.progress.setMaximum(0)
         self.progress.setMinimumDuration(0)
         self.progress.setValue(0)
-        raw_entries = index_stories(self.rootpath, self.progress,
-                                    self.attribute_data)
+        # The entries are shown as they are read, see show_entries
+        self.loader.load(self.rootpath, self.attribute_data,
+                         workers=self.settings.index_workers,
+                         processes=self.settings.index_processes)
+
+    def reset_broken_tag_filter(self, error: tagsystem.ParsingError) -> None:
+        self.error('Failed to reload active tag filter, resetting')
+        self.error(f'[Tag parsing] {error}')
+        self.entry_view.active_filters[ATTR_TAGS] = None
+        self.status_bar.set_filter_info(self.entry_view.active_filters)
+        self.save_state()
+
+    def set_entries(self, entries: Entries) -> None:
         try:
-            self.entry_view.set_entries(raw_entries, self.progress)
+            self.entry_view.set_entries(entries, self.progress)
         except tagsystem.ParsingError as e:
-            self.error('Failed to reload active tag filter, resetting')
-            self.error(f'[Tag parsing] {e}')
-            self.entry_view.active_filters[ATTR_TAGS] = None
-            self.status_bar.set_filter_info(self.entry_view.active_filters)
-            self.entry_view.set_entries(raw_entries, self.progress)
-            self.save_state()
+            self.reset_broken_tag_filter(e)
+            self.entry_view.set_entries(entries, self.progress)
+
+    def show_entries(self, entries: Entries,
+                     removed_files: Iterable[Path] = ()) -> None:
+        """
+        Add or replace entries in the entrylist, without touching the rest.
+        """
+        try:
+            self.entry_view.update_entries(entries, removed_files)
+        except tagsystem.ParsingError as e:
+            # The entries are already updated when the filter fails
+            self.reset_broken_tag_filter(e)
+            self.entry_view.filter_()
+            self.entry_view.sort()
+
+    def finish_reload(self, entries: Entries) -> None:
+        # All entries have been shown already, but the ones that
+        # don't exist anymore have to be removed
+        files = {entry[ATTR_FILE] for entry in entries}
+        self.show_entries((), [entry[ATTR_FILE]
+                               for entry in self.entry_view.entries
+                               if entry[ATTR_FILE] not in files])
+        self.stop_reload()
+
+    def cancel_reload(self) -> None:
+        self.print_('Reload canceled')
+        self.stop_reload()
+
+    def fail_reload(self, message: str) -> None:
+        self.error(message)
+        self.stop_reload()
+
+    def stop_reload(self) -> None:
         self.progress.reset()
+        self.watcher.set_paths(self.story_index.watched_paths())
+        if self.pending_changed_paths:
+            paths = sorted(self.pending_changed_paths)
+            self.pending_changed_paths.clear()
+            self.update_changed_paths(paths)
+
+    def update_changed_paths(self, paths: List[str]) -> None:
+        """
+        Update only the entries affected by changes to the watched files,
+        instead of doing a full reload.
+        """
+        if self.loader.isRunning():
+            # The index can't be touched while it's being updated
+            self.pending_changed_paths.update(paths)
+            return
+        changes = self.story_index.refresh([Path(p) for p in paths],
+                                           self.attribute_data)
+        for error in changes.errors:
+            self.error(error)
+        if changes.entries or changes.removed:
+            self.show_entries(changes.entries, changes.removed)
+        self.watcher.set_paths(self.story_index.watched_paths())
 
     def get_tags(self) -> List[Tuple[str, int]]:
         """
@@ -544,6 +641,7 @@ class IndexView(QtWidgets.QWidget):
         The main filter method, called by terminal command.
 
         If arg is not present, print active filters.
+        If arg is ?, print how long each filter took.
         If arg is -, reset all filters.
         If arg is a category followed by -, reset that filter.
         If arg is a category (t or d) followed by _, show all entries with
@@ -568,6 +666,19 @@ class IndexView(QtWidgets.QWidget):
             else:
                 self.error('No active filters')
             return
+        # Print how long the filters took
+        elif arg.strip() == '?':
+            timings = self.entry_view.filter_timings
+            if timings:
+                self.print_('; '.join(
+                    f'{t.attribute}: {t.payload} ({t.matches} matches'
+                    + ('' if t.estimate is None
+                       else f', ~{t.estimate} expected')
+                    + f', {t.seconds * 1000:.1f} ms)'
+                    for t in timings))
+            else:
+                self.error('No filters were run the last time')
+            return
         # Reset all filters
         elif arg.strip() == '-':
             kwargs = dict(zip(filters.values(), len(filters)*(None,)))
@@ -788,9 +899,7 @@ class IndexView(QtWidgets.QWidget):
         arg should be the index of the entry to be viewed in the meta viewer.
         """
         if not arg.isdigit():
-            partialnames = [n for n, entry
-                            in enumerate(self.entry_view.visible_entries)
-                            if arg.lower() in entry[ATTR_TITLE].lower()]
+            partialnames = self.entry_view.find_visible(ATTR_TITLE, arg)
             if not partialnames:
                 self.error(f'Entry not found: "{arg}"')
                 return
@@ -828,9 +937,7 @@ class IndexView(QtWidgets.QWidget):
         Main external run method, called by terminal command.
         """
         if not arg.isdigit():
-            partialnames = [n for n, entry
-                            in enumerate(self.entry_view.visible_entries)
-                            if arg.lower() in entry[ATTR_TITLE].lower()]
+            partialnames = self.entry_view.find_visible(ATTR_TITLE, arg)
             if not partialnames:
                 self.error(f'Entry not found: "{arg}"')
                 return
@@ -66,6 +66,7 @@ class MainWindow(QtWidgets.QWidget):
                                            'are still open!')
             event.ignore()
         else:
+            self.index_view.loader.stop()
             event.accept()
 
     def connect_signals(self) -> None:
@@ -1,8 +1,17 @@
 import enum
 import re
-from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from operator import ge, gt, itemgetter, le, lt
+from typing import (AbstractSet, Any, Callable, Dict, Generic, Iterable, List,
+                    Mapping, NamedTuple, Optional, Set, Tuple)
 
-from .tagsystem import compile_tag_filter, match_tag_filter
+from .tagsystem import (Group, Key, Macros, Mode, TagIndex, TagVocabulary,
+                        canonical_tag_filter, compile_tag_filter,
+                        compile_tag_mask, optimize_tag_filter,
+                        resolve_tag_filter)
 
 
 class AttrParseError(Exception):
@@ -94,67 +103,637 @@ class Attr(NamedTuple):
         else:
             raise NotImplementedError(f"Can't parse attribute of type {self.type_}")
 
-    def _run_filter(self, payload: str, entries: Entries,
-                    tagmacros: Dict[str, str]) -> bool:
+    def _compile_filter(self, payload: str, tagmacros: Macros,
+                        vocabulary: Optional[TagVocabulary] = None
+                        ) -> 'Predicate':
         if self.type_ == AttrType.TEXT:
-            return any(_filter_text(self.name, payload, entries))
+            return _compile_text_filter(self.name, payload)
         elif self.type_ == AttrType.INT:
-            return any(_filter_number(self.name, payload, entries))
+            return _compile_number_filter(self.name, payload)
         elif self.type_ == AttrType.TAGS:
-            return any(_filter_tags(self.name, payload, entries, tagmacros))
+            return _compile_tags_filter(self.name, payload, tagmacros,
+                                        vocabulary)
         else:
             raise NotImplementedError(f"Can't filter attribute of type {self.type_}")
 
 
 AttributeData = Dict[str, Attr]
+Predicate = Callable[[Entry], bool]
 
 
-def _filter_text(attribute: str, payload: str, entries: Entries
-                 ) -> Iterable[Entry]:
+def _compile_text_filter(attribute: str, payload: str) -> Predicate:
     """
-    Return a tuple with the entries that include the specified text
+    Return a function that checks if an entry includes the specified text
     in the payload variable. The filtering in case-insensitive.
     """
     if not payload:
-        return (entry for entry in entries if not entry[attribute])
+        return lambda entry: not entry[attribute]
     elif payload == NONEMPTY_SEARCH:
-        return (entry for entry in entries if entry[attribute])
+        return lambda entry: bool(entry[attribute])
     else:
-        return (entry for entry in entries
-                if payload.lower() in entry[attribute].lower())
+        folded_payload = payload.casefold()
+        return lambda entry: folded_payload in entry[attribute].casefold()
 
 
-def _filter_number(attribute: str, payload: str, entries: Entries
-                   ) -> Iterable[Entry]:
-    from operator import ge, gt, le, lt
-    compfuncs = {'<': lt, '>': gt, '<=': le, '>=': ge}
-    expressions = [(compfuncs[m.group(1)], int(m.group(2).replace('k', '000')))
-                   for m in re.finditer(r'([<>][=]?)(\d+k?)', payload)]
+_NUMBER_COMPARISONS = {'<': lt, '>': gt, '<=': le, '>=': ge}
+
+
+def _parse_number_filter(payload: str
+                         ) -> List[Tuple[Callable[[Any, Any], bool], int]]:
+    return [(_NUMBER_COMPARISONS[m.group(1)],
+             int(m.group(2).replace('k', '000')))
+            for m in re.finditer(r'([<>][=]?)(\d+k?)', payload)]
+
+
+def _compile_number_filter(attribute: str, payload: str) -> Predicate:
+    expressions = _parse_number_filter(payload)
 
     def matches(entry: Entry) -> bool:
-        return all(fn(entry[attribute], num)
-                   for fn, num in expressions)
-    return filter(matches, entries)
+        value = entry[attribute]
+        return all(fn(value, num) for fn, num in expressions)
+    return matches
 
 
-def _filter_tags(attribute: str, payload: str, entries: Entries,
-                 tagmacros: Dict[str, str]) -> Iterable[Entry]:
+def _compile_tags_filter(attribute: str, payload: str,
+                         tagmacros: Macros,
+                         vocabulary: Optional[TagVocabulary] = None
+                         ) -> Predicate:
+    """
+    Return a function that checks if an entry's tags match a tag filter.
+
+    If a vocabulary (which has to include all of the entries' tags) is
+    specified, the tags are matched as bitmasks.
+    """
     if not payload:
-        return (entry for entry in entries if not entry[attribute])
+        return lambda entry: not entry[attribute]
     elif payload == NONEMPTY_SEARCH:
-        return (entry for entry in entries if entry[attribute])
-    else:
-        tag_filter = compile_tag_filter(payload, tagmacros)
-        return (entry for entry in entries
-                if match_tag_filter(tag_filter, entry[attribute]))
+        return lambda entry: bool(entry[attribute])
+    tag_filter = optimize_tag_filter(compile_tag_filter(payload, tagmacros),
+                                     vocabulary)
+    return _compile_tag_group_filter(attribute, tag_filter, vocabulary)
+
+
+def _compile_tag_group_filter(attribute: str, tag_filter: Group,
+                              vocabulary: Optional[TagVocabulary] = None
+                              ) -> Predicate:
+    if vocabulary is None:
+        matcher = tag_filter.matcher
+        return lambda entry: matcher(entry[attribute])
+    mask_matcher = compile_tag_mask(resolve_tag_filter(tag_filter, vocabulary))
+    mask = vocabulary.mask
+    return lambda entry: mask_matcher(mask(entry[attribute]))
+
+
+# The array type codes of the attribute types that are stored in columns
+_COLUMN_TYPECODES = {AttrType.INT: 'q', AttrType.FLOAT: 'd'}
+
+
+class EntryColumns(Generic[Key]):
+    """
+    The numeric attributes of entries, stored as one array (a column) per
+    attribute instead of in every entry. Each key (eg. an entry) gets a row
+    in the columns.
+
+    Number filters are then run with a binary search in a sorted copy of
+    the column, instead of by comparing the value of every entry.
+
+    A column with a value that doesn't fit in it (eg. text in an INT
+    attribute) is dropped, so it won't be used.
+    """
 
+    def __init__(self, attributedata: AttributeData) -> None:
+        self.columns: Dict[str, 'array[Any]'] = {
+            name: array(_COLUMN_TYPECODES[attr.type_])
+            for name, attr in attributedata.items()
+            if attr.type_ in _COLUMN_TYPECODES
+        }
+        self.rows: Dict[Key, int] = {}
+        # The key of every row, or None if it's been removed
+        self.keys: List[Optional[Key]] = []
+        # How many rows have been removed. They're dropped from the columns
+        # once there are too many of them.
+        self._removed = 0
+        # The values of a column sorted, and the row of every value. Made
+        # when they're needed.
+        self._sorted: Dict[str, Tuple['array[Any]', 'array[int]']] = {}
+
+    def __contains__(self, attribute: str) -> bool:
+        return attribute in self.columns
+
+    def update(self, key: Key, entry: Entry) -> None:
+        """
+        Set the values of the key's row to the entry's, adding a row if
+        the key doesn't have one.
+        """
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        self._sorted.clear()
+        for name, column in list(self.columns.items()):
+            value = entry[name] if name in entry else 0
+            try:
+                if row == len(column):
+                    column.append(value)
+                else:
+                    column[row] = value
+            except (TypeError, OverflowError):
+                del self.columns[name]
+
+    def remove(self, key: Key) -> None:
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        self.keys[row] = None
+        self._removed += 1
+        # Compacting takes time in proportion to the rows that are left, so
+        # doing it when half as many rows have been removed keeps removing
+        # a key cheap on average
+        if self._removed * 2 > len(self.rows):
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Drop the rows of removed keys from the columns.
+        """
+        rows = [row for row, key in enumerate(self.keys) if key is not None]
+        for name, column in self.columns.items():
+            self.columns[name] = array(column.typecode,
+                                       map(column.__getitem__, rows))
+        self.keys = [self.keys[row] for row in rows]
+        self.rows = {key: row for row, key in enumerate(self.keys)
+                     if key is not None}
+        self._removed = 0
+        self._sorted.clear()
+
+    def _sorted_column(self, attribute: str
+                       ) -> Tuple['array[Any]', 'array[int]']:
+        if attribute not in self._sorted:
+            column = self.columns[attribute]
+            rows = sorted(range(len(column)), key=column.__getitem__)
+            self._sorted[attribute] = (
+                array(column.typecode, map(column.__getitem__, rows)),
+                array('q', rows))
+        return self._sorted[attribute]
+
+    def _range(self, attribute: str, payload: str) -> Tuple[int, int]:
+        """
+        Return where the values that match a number filter start and end
+        in the sorted column.
+        """
+        values, _ = self._sorted_column(attribute)
+        start = 0
+        end = len(values)
+        for comparison, number in _parse_number_filter(payload):
+            if comparison is ge:
+                start = max(start, bisect_left(values, number))
+            elif comparison is gt:
+                start = max(start, bisect_right(values, number))
+            elif comparison is le:
+                end = min(end, bisect_right(values, number))
+            else:
+                end = min(end, bisect_left(values, number))
+        return start, max(start, end)
+
+    def count(self, attribute: str, payload: str) -> int:
+        """
+        Return how many values match a number filter (including the ones of
+        removed keys).
+        """
+        start, end = self._range(attribute, payload)
+        return end - start
+
+    def select(self, attribute: str, payload: str,
+               within: Optional[AbstractSet[Key]] = None) -> Set[Key]:
+        """
+        Return the keys whose values match a number filter (eg. ">1k<=5k"),
+        out of the ones in within (or all of them).
+        """
+        start, end = self._range(attribute, payload)
+        if within is not None and len(within) < end - start:
+            # Fewer keys to check than there are matching values
+            column = self.columns[attribute]
+            expressions = _parse_number_filter(payload)
+            rows = self.rows
+            return {key for key in within
+                    if key in rows
+                    and all(fn(column[rows[key]], number)
+                            for fn, number in expressions)}
+        _, sorted_rows = self._sorted_column(attribute)
+        keys = self.keys
+        matching_keys = {key for key
+                         in map(keys.__getitem__, sorted_rows[start:end])
+                         if key is not None}
+        if within is not None:
+            matching_keys.intersection_update(within)
+        return matching_keys
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[n:n + 3] for n in range(len(text) - 2)}
+
+
+class EntryTexts(Generic[Key]):
+    """
+    The text attributes of entries, casefolded once when they're added,
+    so that text filters don't have to casefold every entry again.
+
+    The attributes in trigram_attributes also get an index of every three
+    letter substring in them. A filter with at least three letters is then
+    only checked against the keys that have all of its trigrams. Since the
+    index gets big with long texts, it's best kept to short attributes
+    such as titles.
+
+    A non-text value in a text attribute drops the attribute, so it won't
+    be used.
+    """
+
+    def __init__(self, attributedata: AttributeData,
+                 trigram_attributes: Iterable[str] = ()) -> None:
+        self.texts: Dict[str, Dict[Key, str]] = {
+            name: {} for name, attr in attributedata.items()
+            if attr.type_ == AttrType.TEXT
+        }
+        # The keys with an empty text, by attribute
+        self.empty: Dict[str, Set[Key]] = {name: set() for name in self.texts}
+        self.trigrams: Dict[str, Dict[str, Set[Key]]] = {
+            name: {} for name in trigram_attributes if name in self.texts
+        }
+
+    def __contains__(self, attribute: str) -> bool:
+        return attribute in self.texts
+
+    def update(self, key: Key, entry: Entry) -> None:
+        """
+        Set the key's texts to the entry's casefolded ones.
+        """
+        self.remove(key)
+        for name, texts in list(self.texts.items()):
+            value = entry[name] if name in entry else ''
+            if not isinstance(value, str):
+                del self.texts[name]
+                del self.empty[name]
+                self.trigrams.pop(name, None)
+                continue
+            text = texts[key] = value.casefold()
+            if not text:
+                self.empty[name].add(key)
+            index = self.trigrams.get(name)
+            if index is not None:
+                for trigram in _trigrams(text):
+                    index.setdefault(trigram, set()).add(key)
+
+    def remove(self, key: Key) -> None:
+        for name, texts in self.texts.items():
+            text = texts.pop(key, None)
+            self.empty[name].discard(key)
+            index = self.trigrams.get(name)
+            if text is None or index is None:
+                continue
+            for trigram in _trigrams(text):
+                keys = index[trigram]
+                keys.discard(key)
+                if not keys:
+                    del index[trigram]
+
+    def estimate(self, attribute: str, payload: str) -> int:
+        """
+        Return roughly how many keys match a text filter, without running
+        it. Without a trigram index (or with a payload shorter than a
+        trigram), every key with some text might match.
+        """
+        total = len(self.texts[attribute])
+        empty = len(self.empty[attribute])
+        if not payload:
+            return empty
+        elif payload == NONEMPTY_SEARCH:
+            return total - empty
+        text = payload.casefold()
+        index = self.trigrams.get(attribute)
+        if index is not None and len(text) >= 3:
+            return min(len(index.get(trigram, ()))
+                       for trigram in _trigrams(text))
+        return total - empty
+
+    def containing(self, attribute: str, text: str,
+                   within: Optional[AbstractSet[Key]] = None) -> Set[Key]:
+        """
+        Return the keys whose text includes the specified text, ignoring
+        case, out of the ones in within (or all of them).
+        """
+        texts = self.texts[attribute]
+        text = text.casefold()
+        index = self.trigrams.get(attribute)
+        candidates: Iterable[Key]
+        if index is not None and len(text) >= 3:
+            postings = sorted((index.get(trigram, set())
+                               for trigram in _trigrams(text)), key=len)
+            if within is None or len(postings[0]) < len(within):
+                candidates = postings[0].intersection(*postings[1:])
+                if within is not None:
+                    candidates.intersection_update(within)
+            else:
+                candidates = [key for key in within if key in texts]
+        elif within is None or 2 * len(within) > len(texts):
+            # Going through the texts in order is faster than looking up
+            # most of them
+            matching_keys = {key for key, value in texts.items()
+                             if text in value}
+            if within is not None:
+                matching_keys.intersection_update(within)
+            return matching_keys
+        else:
+            candidates = [key for key in within if key in texts]
+        # Having all of the trigrams doesn't mean they're in the right order
+        return {key for key in candidates if text in texts[key]}
+
+    def select(self, attribute: str, payload: str,
+               within: Optional[AbstractSet[Key]] = None) -> Set[Key]:
+        """
+        Return the keys whose text matches a text filter, out of the ones
+        in within (or all of them).
+        """
+        if not payload:
+            empty = self.empty[attribute]
+            return set(empty) if within is None else empty.intersection(within)
+        elif payload == NONEMPTY_SEARCH:
+            texts = self.texts[attribute]
+            empty = self.empty[attribute]
+            if within is None:
+                return {key for key in texts if key not in empty}
+            return {key for key in within
+                    if key in texts and key not in empty}
+        return self.containing(attribute, payload, within)
+
+
+class FilterTiming(NamedTuple):
+    attribute: str
+    payload: str
+    # How many keys the filter was expected to leave (None if there was
+    # nothing to base a guess on) and how many it did
+    estimate: Optional[int]
+    matches: int
+    seconds: float
+
+
+# Roughly how much checking a filter on an entry costs, by the type of the
+# attribute, so that the cheap filters can be checked first
+_FILTER_COSTS = {AttrType.INT: 0, AttrType.FLOAT: 0, AttrType.TEXT: 1,
+                 AttrType.TAGS: 2}
+
+
+class FilterPlan:
+    """
+    A set of active filters, compiled once and then applied to any number
+    of entries.
+
+    Everything that doesn't depend on the entry (parsing tag filters and
+    numeric comparisons, casefolding text) is done when the plan is created,
+    so checking an entry is just a call per filter. The cheapest filters are
+    checked first, and among them the ones with the longest payloads (which
+    are likely to match fewer entries).
+
+    If a tag vocabulary with all of the entries' tags is specified, tag
+    filters are matched using bitmasks.
+
+    If tag indexes (by attribute) are specified, the tag filters of those
+    attributes are left out of matches() and are instead run on the indexes
+    with indexed_matches(). The same goes for number filters if the entries'
+    columns are specified, and for text filters if the entries' texts are.
+    The tag indexes, the columns and the texts have to use the same keys.
+    The filters that are expected to match the fewest keys are run first,
+    and the rest only check the keys that are left.
+
+    select() runs all of the filters, and saves how long each of them took
+    in timings, in the order they were run.
+
+    Tag filters are optimized before they're used (see optimize_tag_filter),
+    and key is the same for plans with filters that are the same after that.
+    """
 
-def filter_entry(entry: Entry, filters: Iterable[Tuple[str, str]],
+    def __init__(self, filters: Iterable[Tuple[str, str]],
                  attributedata: AttributeData,
-                 tagmacros: Dict[str, str]) -> bool:
-    for attribute, payload in filters:
-        attr = attributedata[attribute]
-        if not attr._run_filter(payload, tuple([entry]), tagmacros):
+                 tagmacros: Macros,
+                 vocabulary: Optional[TagVocabulary] = None,
+                 tag_indexes: Optional[Mapping[str, TagIndex[Any]]] = None,
+                 columns: Optional[EntryColumns[Any]] = None,
+                 texts: Optional[EntryTexts[Any]] = None
+                 ) -> None:
+        self.filters = tuple(filters)
+        self.tag_indexes = tag_indexes or {}
+        self.columns = columns
+        self.texts = texts
+        self.tag_filters: List[Tuple[str, str, Group]] = []
+        self.column_filters: List[Tuple[str, str]] = []
+        self.text_filters: List[Tuple[str, str]] = []
+        # The filters that are checked on every entry, with their cost
+        checked_filters: List[Tuple[Tuple[int, int], str, str,
+                                    Predicate]] = []
+        self.timings: List[FilterTiming] = []
+        keys = []
+        for attribute, payload in self.filters:
+            attr = attributedata[attribute]
+            if columns is not None and attribute in columns:
+                self.column_filters.append((attribute, payload))
+                keys.append((attribute, payload))
+                continue
+            if texts is not None and attribute in texts:
+                self.text_filters.append((attribute, payload))
+                keys.append((attribute, payload))
+                continue
+            if not payload or payload == NONEMPTY_SEARCH:
+                cost = (0, 0)
+            else:
+                cost = (_FILTER_COSTS.get(attr.type_, 1), -len(payload))
+            if attr.type_ != AttrType.TAGS or not payload \
+                    or payload == NONEMPTY_SEARCH:
+                checked_filters.append((cost, attribute, payload,
+                                        attr._compile_filter(
+                                            payload, tagmacros, vocabulary)))
+                keys.append((attribute, payload))
+                continue
+            tag_filter = compile_tag_filter(payload, tagmacros)
+            tag_index = self.tag_indexes.get(attribute)
+            if tag_index is not None:
+                tag_filter = optimize_tag_filter(
+                    tag_filter, tag_index.vocabulary, tag_index.count,
+                    len(tag_index.keys))
+                self.tag_filters.append((attribute, payload, tag_filter))
+            else:
+                tag_filter = optimize_tag_filter(tag_filter, vocabulary)
+                checked_filters.append((cost, attribute, payload,
+                                        _compile_tag_group_filter(
+                                            attribute, tag_filter,
+                                            vocabulary)))
+            keys.append((attribute, canonical_tag_filter(tag_filter)))
+        checked_filters.sort(key=itemgetter(0))
+        self.predicates: List[Tuple[str, str, Predicate]] = [
+            (attribute, payload, predicate)
+            for _, attribute, payload, predicate in checked_filters
+        ]
+        self.key = tuple(sorted(keys))
+
+    def matches(self, entry: Entry) -> bool:
+        for _, _, predicate in self.predicates:
+            if not predicate(entry):
+                return False
+        return True
+
+    def indexed_matches(self, within: Optional[AbstractSet[Any]] = None
+                        ) -> Optional[Set[Any]]:
+        """
+        Return the keys in the tag indexes, columns and texts (out of the
+        ones in within, if specified) that match all of the filters that
+        are run on them, or None if there are no such filters.
+        """
+        self.timings = []
+        # The filters with how many keys they're expected to match
+        filters: List[Tuple[int, str, str,
+                            Callable[..., Set[Any]]]] = []
+        for attribute, payload in self.column_filters:
+            assert self.columns is not None
+            filters.append((self.columns.count(attribute, payload),
+                            attribute, payload,
+                            partial(self.columns.select, attribute, payload)))
+        for attribute, payload in self.text_filters:
+            assert self.texts is not None
+            filters.append((self.texts.estimate(attribute, payload),
+                            attribute, payload,
+                            partial(self.texts.select, attribute, payload)))
+        for attribute, payload, tag_filter in self.tag_filters:
+            tag_index = self.tag_indexes[attribute]
+            filters.append((tag_index.estimate(tag_filter), attribute, payload,
+                            partial(tag_index.select, tag_filter)))
+        if not filters:
+            return None
+        filters.sort(key=itemgetter(0))
+        keys: Optional[AbstractSet[Any]] = within
+        matching_keys: Set[Any] = set()
+        for estimate, attribute, payload, select in filters:
+            start = time.perf_counter()
+            if keys is not None and estimate < len(keys):
+                # Cheaper to run the filter on its own and keep what it
+                # has in common with the keys that are left
+                matching_keys = select()
+                matching_keys.intersection_update(keys)
+            else:
+                matching_keys = select(within=keys)
+            keys = matching_keys
+            self.timings.append(FilterTiming(attribute, payload, estimate,
+                                             len(keys),
+                                             time.perf_counter() - start))
+            if not keys:
+                break
+        return matching_keys
+
+    def select(self, keys: Iterable[Any], entry: Callable[[Any], Entry],
+               narrow: bool = False) -> Set[Any]:
+        """
+        Return the keys whose entries (returned by entry) match all of the
+        filters.
+
+        If any filters are run on the indexes, their result is used instead
+        of keys, and the other filters only check the keys in it. If narrow
+        is True, keys are known to include every key that matches (eg.
+        they're the result of looser filters, see is_refinement), so the
+        filters on the indexes only check them too.
+        """
+        if narrow:
+            within = keys if isinstance(keys, (set, frozenset)) \
+                else set(keys)
+            keys = within
+            indexed_keys = self.indexed_matches(within)
+        else:
+            indexed_keys = self.indexed_matches()
+        candidates = list(keys if indexed_keys is None else indexed_keys)
+        for attribute, payload, predicate in self.predicates:
+            if not candidates:
+                break
+            start = time.perf_counter()
+            candidates = [key for key in candidates if predicate(entry(key))]
+            self.timings.append(FilterTiming(attribute, payload, None,
+                                             len(candidates),
+                                             time.perf_counter() - start))
+        return set(candidates)
+
+
+# A bound of a number filter: the number and whether it's strict for
+# lower bounds, or inclusive for upper bounds, so that a greater lower
+# bound or a smaller upper bound is always tighter
+_Bound = Tuple[float, bool]
+
+
+def _number_bounds(payload: str) -> Tuple[_Bound, _Bound]:
+    lower: _Bound = (float('-inf'), False)
+    upper: _Bound = (float('inf'), True)
+    for comparison, number in _parse_number_filter(payload):
+        if comparison is ge or comparison is gt:
+            lower = max(lower, (number, comparison is gt))
+        else:
+            upper = min(upper, (number, comparison is le))
+    return lower, upper
+
+
+def _and_terms(tag_filter: Group) -> Set[str]:
+    """
+    Return the canonical forms of the items that all have to match for the
+    tag filter to match.
+    """
+    if not tag_filter.invert and (tag_filter.mode is Mode.AND
+                                  or len(tag_filter.content) == 1):
+        return {canonical_tag_filter(item) for item in tag_filter.content}
+    return {canonical_tag_filter(tag_filter)}
+
+
+def _refines_filter(attr: Attr, old_payload: str, new_payload: str,
+                    tagmacros: Macros) -> bool:
+    if new_payload == old_payload:
+        return True
+    special_payloads = {'', NONEMPTY_SEARCH}
+    if attr.type_ == AttrType.TEXT:
+        if old_payload == NONEMPTY_SEARCH:
+            # Anything that includes some text isn't empty
+            return new_payload not in special_payloads
+        return old_payload not in special_payloads \
+            and new_payload not in special_payloads \
+            and old_payload.casefold() in new_payload.casefold()
+    elif attr.type_ in {AttrType.INT, AttrType.FLOAT}:
+        old_lower, old_upper = _number_bounds(old_payload)
+        new_lower, new_upper = _number_bounds(new_payload)
+        return new_lower >= old_lower and new_upper <= old_upper
+    elif attr.type_ == AttrType.TAGS:
+        if old_payload in special_payloads \
+                or new_payload in special_payloads:
+            return False
+        old_filter = optimize_tag_filter(compile_tag_filter(old_payload,
+                                                            tagmacros))
+        new_filter = optimize_tag_filter(compile_tag_filter(new_payload,
+                                                            tagmacros))
+        return _and_terms(old_filter) <= _and_terms(new_filter)
+    return False
+
+
+def is_refinement(old_filters: Iterable[Tuple[str, str]],
+                  new_filters: Iterable[Tuple[str, str]],
+                  attributedata: AttributeData,
+                  tagmacros: Macros) -> bool:
+    """
+    Return True if the new filters only match entries that the old filters
+    match too, by checking that every filter was kept or made stricter: a
+    filter was added, text was added around a text filter's payload, a
+    text filter that only required some text (NONEMPTY_SEARCH) was given
+    actual text, a number filter's bounds were tightened or items were
+    added to an AND group of tags.
+
+    False doesn't mean that the new filters match anything else, only that
+    it isn't easy to tell.
+    """
+    new_payloads = dict(new_filters)
+    for attribute, old_payload in old_filters:
+        new_payload = new_payloads.get(attribute)
+        if new_payload is None or not _refines_filter(
+                attributedata[attribute], old_payload, new_payload,
+                tagmacros):
             return False
     return True
 
@@ -1,26 +1,15 @@
 import enum
 import re
-from typing import Any, Collection, Dict, List, NamedTuple, Optional, Union
+from bisect import bisect_left
+from typing import (AbstractSet, Any, Callable, Collection, Dict, FrozenSet,
+                    Generic, Hashable, Iterable, Iterator, List, NamedTuple,
+                    Optional, Set, Tuple, TypeVar, Union)
 
 
 class ParsingError(Exception):
     pass
 
 
-def _expand_macros(string: str, macros: Dict[str, str]) -> str:
-    while True:
-        str_macros = re.findall('@[^(),|]+', string)
-        if not str_macros:
-            break
-        for m in str_macros:
-            mname = m.strip().lstrip('@')
-            if mname not in macros:
-                raise ParsingError('Unknown tag macro')
-            else:
-                string = string.replace(m, '(' + macros[mname] + ')')
-    return string
-
-
 class TokenType(enum.Enum):
     START_GROUP = enum.auto()
     START_NEG_GROUP = enum.auto()
@@ -104,12 +93,27 @@ class Mode(enum.Enum):
     OR = '|'
 
 
+TagMatcher = Callable[[Collection[str]], bool]
+
+
 class Group:
     def __init__(self, mode: Optional[Mode], invert: bool,
                  content: List[Union['Group', str]]) -> None:
         self.mode = mode or Mode.OR
         self.content = content
         self.invert = invert
+        self._matcher: Optional[TagMatcher] = None
+
+    @property
+    def matcher(self) -> TagMatcher:
+        """
+        The group compiled into a function (see compile_tag_matcher). It's
+        compiled the first time it's used, so the group shouldn't be
+        changed after that.
+        """
+        if self._matcher is None:
+            self._matcher = compile_tag_matcher(self)
+        return self._matcher
 
     def __repr__(self) -> str:
         invert_str = '(NOT) ' if self.invert else ''
@@ -123,39 +127,138 @@ class Group:
             and self.content == other.content
 
 
-def _read_from(tokens: List[Token]) -> Group:
+class TagMacros:
+    """
+    Tag macros, parsed into groups once so that they can be spliced into
+    tag filters when the filters are parsed.
+
+    Macros can use other macros. The ones that can't be parsed, eg. because
+    they (indirectly) use themselves, are left out and their errors are in
+    errors instead.
+    """
+
+    def __init__(self, macros: Dict[str, str]) -> None:
+        self.groups: Dict[str, Group] = {}
+        self.errors: Dict[str, str] = {}
+        for name in macros:
+            try:
+                self._compile(name, macros, [])
+            except ParsingError:
+                pass
+
+    def _compile(self, name: str, macros: Dict[str, str],
+                 stack: List[str]) -> Group:
+        if name in self.groups:
+            return self.groups[name]
+        if name in self.errors:
+            raise ParsingError(self.errors[name])
+        if name not in macros:
+            raise ParsingError(f'Unknown tag macro @{name}')
+        if name in stack:
+            cycle = stack[stack.index(name):] + [name]
+            raise ParsingError('Recursive tag macro: '
+                               + ' -> '.join(f'@{n}' for n in cycle))
+        stack.append(name)
+        try:
+            group = self.groups[name] = _read_from(
+                _tokenize(macros[name]),
+                lambda used_name: self._compile(used_name, macros, stack))
+        except ParsingError as e:
+            self.errors[name] = str(e)
+            raise
+        finally:
+            stack.pop()
+        return group
+
+    def group(self, name: str) -> Group:
+        if name in self.groups:
+            return self.groups[name]
+        elif name in self.errors:
+            raise ParsingError(f'Broken tag macro @{name}: '
+                               f'{self.errors[name]}')
+        else:
+            raise ParsingError(f'Unknown tag macro @{name}')
+
+
+# Either raw tag macros or already compiled ones
+Macros = Union[Dict[str, str], TagMacros]
+# Returns the group of a macro by its name
+MacroLookup = Callable[[str], Group]
+
+
+def _no_macros(name: str) -> Group:
+    raise ParsingError(f'Unknown tag macro @{name}')
+
+
+def _splice_macro(lexeme: str, macros: MacroLookup) -> Group:
+    """
+    Return the group of a macro token (@name or -@name). The macro's own
+    group is copied, since it's used in other filters too.
+    """
+    negative = lexeme.startswith('-')
+    group = macros(lexeme.lstrip('-').strip().lstrip('@'))
+    return Group(group.mode, group.invert != negative, group.content)
+
+
+class _OpenGroup:
+    """
+    A group that's still being read.
+    """
+    def __init__(self, invert: bool) -> None:
+        self.invert = invert
+        self.mode: Optional[Mode] = None
+        self.content: List[Union[Group, str]] = []
+
+    def close(self) -> Group:
+        content = self.content
+        if len(content) == 1 and isinstance(content[0], Group):
+            # A group with only a group in it is the same as that group
+            if self.invert:
+                content[0].invert = not content[0].invert
+            return content[0]
+        return Group(self.mode, self.invert, content)
+
+
+def _read_from(tokens: List[Token], macros: MacroLookup = _no_macros
+               ) -> Group:
+    """
+    Read the group that starts with the first token.
+
+    The tokens are read in order with an explicit stack of the groups that
+    are open, so that very long filters are read in linear time and very
+    deeply nested ones don't hit the recursion limit.
+    """
     if not tokens:
         raise ParsingError('No tokens')
     TT = TokenType
     modes = {TT.AND: Mode.AND, TT.OR: Mode.OR}
-    mode: Optional[Mode] = None
-    groups: List[Union[Group, str]] = []
-    opening_token = tokens.pop(0)
+    opening_token = tokens[0]
     if opening_token.type_ not in {TT.START_GROUP, TT.START_NEG_GROUP}:
         raise ParsingError(f'Invalid syntax: expected a group but got '
                            f'"{opening_token.lexeme}"')
-    invert = opening_token.type_ is TT.START_NEG_GROUP
-    while tokens:
-        token = tokens.pop(0)
+    stack = [_OpenGroup(opening_token.type_ is TT.START_NEG_GROUP)]
+    for pos in range(1, len(tokens)):
+        token = tokens[pos]
+        current = stack[-1]
         if token.type_ is TT.END_GROUP:
-            if len(groups) == 1 and isinstance(groups[0], Group):
-                if invert:
-                    groups[0].invert = invert != groups[0].invert
-                return groups[0]
-            else:
-                return Group(mode, invert, groups)
-        elif token.type_ is TT.START_GROUP \
-                or token.type_ is TT.START_NEG_GROUP:
-            # Re-add the token for peace of mind and consistency
-            tokens.insert(0, token)
-            groups.append(_read_from(tokens))
+            group = stack.pop().close()
+            if not stack:
+                return group
+            stack[-1].content.append(group)
+        elif token.type_ is TT.START_GROUP:
+            stack.append(_OpenGroup(False))
+        elif token.type_ is TT.START_NEG_GROUP:
+            stack.append(_OpenGroup(True))
         elif token.type_ is TT.AND or token.type_ is TT.OR:
             new_mode = modes[token.type_]
-            if mode is not None and mode is not new_mode:
+            if current.mode is not None and current.mode is not new_mode:
                 raise ParsingError('Invalid syntax: mixed separators')
-            mode = new_mode
+            current.mode = new_mode
         elif token.type_ is TT.NAME:
-            groups.append(token.lexeme)
+            if token.lexeme.lstrip('-').startswith('@'):
+                current.content.append(_splice_macro(token.lexeme, macros))
+            else:
+                current.content.append(token.lexeme)
         else:
             raise NotImplementedError
     raise ParsingError('Invalid syntax: group wasn\'t closed')
@@ -210,9 +313,610 @@ def _parse(group: Group, oldtags: Collection[str]) -> bool:
         raise ParsingError('Invalid expression')
 
 
-def compile_tag_filter(string: str, macros: Dict[str, str]) -> Group:
-    return _read_from(_tokenize(_expand_macros(string, macros)))
+def _compile_tag(tag: str) -> TagMatcher:
+    negative = tag.startswith('-')
+    tag = tag.lstrip('-')
+    if '*' in tag:
+        match = re.compile(tag.replace('*', '.+') + '$').match
+        if negative:
+            return lambda tags: not any(map(match, tags))
+        return lambda tags: any(map(match, tags))
+    if negative:
+        return lambda tags: tag not in tags
+    return lambda tags: tag in tags
+
+
+def compile_tag_matcher(group: Group) -> TagMatcher:
+    """
+    Compile a tag filter into a single function that checks if a set of
+    tags matches it.
+
+    The wildcards and negations are resolved when compiling, and groups of
+    plain tags are checked all at once, so matching doesn't have to look at
+    the group tree at all. Gives the same result as _parse.
+    """
+    invert = group.invert
+    and_mode = group.mode is Mode.AND
+    tags = [item for item in group.content
+            if isinstance(item, str) and '*' not in item]
+    matchers = [_compile_tag(item) if isinstance(item, str)
+                else compile_tag_matcher(item)
+                for item in group.content
+                if not isinstance(item, str) or '*' in item]
+    required = frozenset(tag for tag in tags if not tag.startswith('-'))
+    forbidden = frozenset(tag.lstrip('-') for tag in tags
+                          if tag.startswith('-'))
+    if and_mode:
+        if not matchers:
+            return lambda oldtags: (required.issubset(oldtags)
+                                    and forbidden.isdisjoint(oldtags)
+                                    ) != invert
+        return lambda oldtags: (required.issubset(oldtags)
+                                and forbidden.isdisjoint(oldtags)
+                                and all(m(oldtags) for m in matchers)
+                                ) != invert
+    else:
+        if not matchers and not forbidden:
+            return lambda oldtags: (not required.isdisjoint(oldtags)
+                                    ) != invert
+        return lambda oldtags: (not required.isdisjoint(oldtags)
+                                or not forbidden.issubset(oldtags)
+                                or any(m(oldtags) for m in matchers)
+                                ) != invert
+
+
+def compile_tag_filter(string: str, macros: Macros) -> Group:
+    if not isinstance(macros, TagMacros):
+        macros = TagMacros(macros)
+    return _read_from(_tokenize(string), macros.group)
+
+
+class TagVocabulary:
+    """
+    All known tags, each interned to an integer id.
+
+    A set of tags can then be stored as an int bitmask, where bit n is set
+    if the tag with id n is in the set, and checking tags is done with
+    integer operations instead of hashing strings.
+    """
+
+    def __init__(self, tags: Iterable[str] = ()) -> None:
+        self.ids: Dict[str, int] = {}
+        self._masks: Dict[FrozenSet[str], int] = {}
+        # All tags sorted, and all tags reversed and sorted, to find the
+        # tags with a prefix or suffix. Made when they're needed.
+        self._sorted: Optional[List[str]] = None
+        self._sorted_reversed: Optional[List[str]] = None
+        self._expanded: Dict[str, FrozenSet[str]] = {}
+        self.update(tags)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids)
+
+    def intern(self, tag: str) -> int:
+        """
+        Return the id of the tag, giving it a new one if it's not known.
+        """
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            tag_id = self.ids[tag] = len(self.ids)
+            if self._sorted is not None:
+                self._sorted = self._sorted_reversed = None
+            if self._expanded:
+                self._expanded = {}
+        return tag_id
+
+    def update(self, tags: Iterable[str]) -> None:
+        for tag in tags:
+            self.intern(tag)
+
+    def mask(self, tags: Collection[str]) -> int:
+        """
+        Return the bitmask of a set of tags, adding any unknown tags to
+        the vocabulary.
+
+        The masks of frozensets (which is what entries' tags are) are
+        remembered, so getting the mask of the same set again is a single
+        dict lookup.
+        """
+        if isinstance(tags, frozenset):
+            mask = self._masks.get(tags)
+            if mask is None:
+                mask = self._masks[tags] = self._make_mask(tags)
+            return mask
+        return self._make_mask(tags)
+
+    def _make_mask(self, tags: Iterable[str]) -> int:
+        mask = 0
+        for tag in tags:
+            mask |= 1 << self.intern(tag)
+        return mask
+
+    def expand(self, pattern: str) -> FrozenSet[str]:
+        """
+        Return all known tags that match a wildcard pattern, where every *
+        matches one or more characters.
+
+        The tags are found with a binary search among the sorted tags (for
+        the part before the first *) and the sorted reversed tags (for the
+        part after the last *), so only the tags that start and end right
+        have to be checked. The result is remembered until a new tag is
+        added.
+        """
+        tags = self._expanded.get(pattern)
+        if tags is None:
+            tags = self._expanded[pattern] = self._expand(pattern)
+        return tags
+
+    def _expand(self, pattern: str) -> FrozenSet[str]:
+        rx = re.compile(pattern.replace('*', '.+') + '$')
+        if _REGEX_CHARS.search(pattern):
+            # The pattern is used as a regex, so any tag could match
+            return frozenset(tag for tag in self.ids if rx.match(tag))
+        if self._sorted is None or self._sorted_reversed is None:
+            self._sorted = sorted(self.ids)
+            self._sorted_reversed = sorted(tag[::-1] for tag in self.ids)
+        prefix = pattern[:pattern.index('*')]
+        suffix = pattern[pattern.rindex('*') + 1:]
+        candidates = _with_prefix(self._sorted, prefix)
+        if suffix:
+            with_suffix = _with_prefix(self._sorted_reversed, suffix[::-1])
+            if len(with_suffix) < len(candidates):
+                candidates = [tag[::-1] for tag in with_suffix]
+        return frozenset(tag for tag in candidates if rx.match(tag))
+
+    def pattern_mask(self, pattern: str) -> int:
+        """
+        Return the bitmask of all known tags that match a wildcard pattern.
+        """
+        return self._make_mask(self.expand(pattern))
+
+
+# Characters that mean something in a regex, other than the * wildcard
+_REGEX_CHARS = re.compile(r'[.^$+?{}\[\]\\|()]')
+
+
+def _with_prefix(sorted_tags: List[str], prefix: str) -> List[str]:
+    """
+    Return the tags in a sorted list that start with prefix.
+    """
+    start = end = bisect_left(sorted_tags, prefix)
+    while end < len(sorted_tags) and sorted_tags[end].startswith(prefix):
+        end += 1
+    return sorted_tags[start:end]
+
+
+# A tag in a filter resolved to a bitmask: the mask of the tag (or all
+# tags matching its wildcard) and whether the tag is negated
+_MaskTag = Tuple[int, bool]
+
+
+class MaskGroup(NamedTuple):
+    """
+    A Group whose tags have been resolved to bitmasks.
+    """
+    mode: Mode
+    invert: bool
+    content: Tuple[Union['MaskGroup', _MaskTag], ...]
+
+
+def _resolve_tag(tag: str, vocabulary: TagVocabulary) -> _MaskTag:
+    negative = tag.startswith('-')
+    tag = tag.lstrip('-')
+    if '*' in tag:
+        return vocabulary.pattern_mask(tag), negative
+    tag_id = vocabulary.ids.get(tag)
+    # An unknown tag is left out of the vocabulary, and like a wildcard
+    # that matches no tags, its empty mask is never set
+    return (0 if tag_id is None else 1 << tag_id), negative
+
+
+def resolve_tag_filter(tag_filter: Group, vocabulary: TagVocabulary
+                       ) -> MaskGroup:
+    """
+    Resolve all tags in a filter to bitmasks.
+
+    Wildcards are matched against the tags in the vocabulary, so it has to
+    include all tags that the filter will be matched against. Tags that
+    aren't in the vocabulary are not added to it (no entry has them, so
+    they never match).
+    """
+    return MaskGroup(tag_filter.mode, tag_filter.invert, tuple(
+        _resolve_tag(item, vocabulary) if isinstance(item, str)
+        else resolve_tag_filter(item, vocabulary)
+        for item in tag_filter.content
+    ))
+
+
+def _match_mask(item: Union[MaskGroup, _MaskTag], mask: int) -> bool:
+    if isinstance(item, MaskGroup):
+        return match_tag_mask(item, mask)
+    tag_mask, negative = item
+    # A wildcard matches if any of its tags are there
+    return (mask & tag_mask == 0) == negative
+
+
+def match_tag_mask(tag_filter: MaskGroup, mask: int) -> bool:
+    """
+    Like _parse, but with the tags as a bitmask.
+    """
+    if tag_filter.mode is Mode.AND:
+        return all(_match_mask(item, mask)
+                   for item in tag_filter.content) != tag_filter.invert
+    else:
+        return any(_match_mask(item, mask)
+                   for item in tag_filter.content) != tag_filter.invert
+
+
+MaskMatcher = Callable[[int], bool]
+
+
+def _compile_wildcard_mask(tag_mask: int, negative: bool) -> MaskMatcher:
+    """
+    Return a function that checks if none of the tags in tag_mask are in a
+    bitmask (if negative), or if any of them are.
+    """
+    def matches(mask: int) -> bool:
+        return (mask & tag_mask == 0) == negative
+    return matches
+
+
+def compile_tag_mask(tag_filter: MaskGroup) -> MaskMatcher:
+    """
+    Compile a resolved tag filter into a single function that checks if a
+    bitmask of tags matches it. Gives the same result as match_tag_mask.
+
+    All plain tags in a group are combined into one mask. An AND group
+    checks that all of its tags are set with one comparison, and an OR
+    group checks if any of them are set with one AND.
+    """
+    invert = tag_filter.invert
+    and_mode = tag_filter.mode is Mode.AND
+    # Tags that have to be there for an AND group, or any of which has to be
+    # there for an OR group
+    required = 0
+    # Tags that can't be there for an AND group, or any of which can be
+    # missing for an OR group
+    forbidden = 0
+    matchers: List[MaskMatcher] = []
+    for item in tag_filter.content:
+        if isinstance(item, MaskGroup):
+            matchers.append(compile_tag_mask(item))
+            continue
+        tag_mask, negative = item
+        single_tag = tag_mask & (tag_mask - 1) == 0 and tag_mask != 0
+        if negative and (and_mode or single_tag):
+            # None of the tags in (a wildcard's) mask can be there
+            forbidden |= tag_mask
+        elif not negative and (not and_mode or single_tag):
+            required |= tag_mask
+        elif negative:
+            # A negated wildcard in an OR group: none of its tags can be there
+            matchers.append(_compile_wildcard_mask(tag_mask, negative=True))
+        else:
+            # A wildcard in an AND group: any of its tags has to be there
+            matchers.append(_compile_wildcard_mask(tag_mask, negative=False))
+    if and_mode:
+        if not matchers:
+            return lambda mask: (mask & required == required
+                                 and mask & forbidden == 0) != invert
+        return lambda mask: (mask & required == required
+                             and mask & forbidden == 0
+                             and all(m(mask) for m in matchers)) != invert
+    else:
+        if not matchers and not forbidden:
+            return lambda mask: (mask & required != 0) != invert
+        return lambda mask: (mask & required != 0
+                             or mask & forbidden != forbidden
+                             or any(m(mask) for m in matchers)) != invert
+
+
+Key = TypeVar('Key', bound=Hashable)
+
+
+class TagIndex(Generic[Key]):
+    """
+    An inverted index of tags: the keys (eg. entries) that have each tag.
+
+    Finding the keys that match a tag filter is then done with set
+    operations on the keys of the filter's tags, instead of checking every
+    key's tags against the filter.
+
+    Wildcards are expanded with the vocabulary, which is updated with all
+    tags that are added to the index, and may be shared between indexes.
+    """
+
+    def __init__(self, vocabulary: Optional[TagVocabulary] = None) -> None:
+        self.vocabulary = vocabulary if vocabulary is not None \
+            else TagVocabulary()
+        self.keys: Set[Key] = set()
+        self.postings: Dict[str, Set[Key]] = {}
+
+    def add(self, key: Key, tags: Iterable[str]) -> None:
+        self.replace(key, (), tags)
+
+    def remove(self, key: Key, tags: Iterable[str]) -> None:
+        """
+        Remove a key, which has to be removed with the tags it was added
+        with.
+        """
+        self.keys.discard(key)
+        self._remove_tags(key, tags)
+
+    def replace(self, key: Key, old_tags: Iterable[str],
+                new_tags: Iterable[str]) -> None:
+        """
+        Change a key's tags from old_tags to new_tags, adding the key if
+        it's not in the index already.
+        """
+        old_tags = frozenset(old_tags)
+        new_tags = frozenset(new_tags)
+        self.keys.add(key)
+        self._remove_tags(key, old_tags - new_tags)
+        self.vocabulary.update(new_tags)
+        for tag in new_tags - old_tags:
+            keys = self.postings.get(tag)
+            if keys is None:
+                keys = self.postings[tag] = set()
+            keys.add(key)
 
+    def _remove_tags(self, key: Key, tags: Iterable[str]) -> None:
+        for tag in tags:
+            keys = self.postings.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[tag]
 
-def match_tag_filter(tag_filter: Group, oldtags: Collection[str]) -> bool:
-    return _parse(tag_filter, oldtags)
+    def count(self, tag: str) -> int:
+        """
+        Return how many keys have the tag (or any tag matching it, if it's
+        a wildcard).
+        """
+        return len(self._tag_keys(tag))
+
+    def _tag_keys(self, tag: str) -> Set[Key]:
+        tag = tag.lstrip('-')
+        if '*' not in tag:
+            return self.postings.get(tag, set())
+        keys: Set[Key] = set()
+        for match in self.vocabulary.expand(tag):
+            keys.update(self.postings.get(match, ()))
+        return keys
+
+    def estimate(self, tag_filter: Group) -> int:
+        """
+        Return roughly how many keys match the tag filter, without running
+        it.
+        """
+        return estimate_tag_filter(tag_filter, self.count, len(self.keys))
+
+    def select(self, tag_filter: Group,
+               within: Optional[AbstractSet[Key]] = None) -> Set[Key]:
+        """
+        Return the keys whose tags match the tag filter, out of the ones in
+        within (or all of them). Gives the same result as checking every
+        key with _parse.
+        """
+        return self._select(tag_filter,
+                            set(self.keys if within is None else within))
+
+    def _select(self, group: Group, within: Set[Key]) -> Set[Key]:
+        # Each item of the group with the number of keys it leaves (for an
+        # AND group) or adds (for an OR group) at most, and its keys
+        terms: List[Tuple[int, Union[Group, str], Set[Key]]] = []
+        for item in group.content:
+            if isinstance(item, Group):
+                terms.append((len(within), item, set()))
+            else:
+                keys = self._tag_keys(item)
+                size = len(keys)
+                if item.startswith('-'):
+                    size = len(within) - size
+                terms.append((max(size, 0), item, keys))
+        result: Set[Key]
+        if group.mode is Mode.AND:
+            # Start with the most selective item, so that the rest only
+            # have to look at the keys that are left
+            terms.sort(key=lambda term: term[0])
+            result = within
+            for _, item, keys in terms:
+                if not result:
+                    break
+                if isinstance(item, Group):
+                    result = self._select(item, result)
+                elif item.startswith('-'):
+                    result = result - keys
+                else:
+                    result = result & keys
+        else:
+            # Start with the item that adds the most keys, so that the rest
+            # (especially groups) only have to look at the keys that are left
+            terms.sort(key=lambda term: term[0], reverse=True)
+            result = set()
+            for _, item, keys in terms:
+                if len(result) == len(within):
+                    break
+                if isinstance(item, Group):
+                    result |= self._select(item, within - result)
+                elif item.startswith('-'):
+                    result |= within - keys
+                else:
+                    result |= within & keys
+        if group.invert:
+            return within - result
+        return result
+
+
+# A tag filter item while it's optimized: a tag, a group or a constant
+_Item = Union[Group, str, bool]
+
+
+def _negate_content(item: Union[Group, str]) -> Union[Group, str]:
+    if isinstance(item, str):
+        return item[1:] if item.startswith('-') else f'-{item}'
+    return Group(item.mode, not item.invert, item.content)
+
+
+def _negate(item: _Item) -> _Item:
+    if isinstance(item, bool):
+        return not item
+    return _negate_content(item)
+
+
+def canonical_tag_filter(item: Union[Group, str]) -> str:
+    """
+    Return a string that is the same for tag filters that only differ in
+    the order of their items. Meant to be used on optimized filters, which
+    have no redundant groups or duplicates left.
+    """
+    if isinstance(item, str):
+        return item
+    content = sorted(canonical_tag_filter(x) for x in item.content)
+    return (f'{"-" if item.invert else ""}('
+            f'{item.mode.value.join(content) if content else item.mode.value}'
+            f')')
+
+
+class _Optimizer:
+    def __init__(self, known: Optional[Callable[[str], bool]],
+                 count: Optional[Callable[[str], int]], total: int) -> None:
+        self.known = known
+        self.count = count
+        self.total = total
+
+    def estimate(self, item: Union[Group, str]) -> int:
+        """
+        Return roughly how many keys (eg. entries) match the item.
+        """
+        if self.count is None:
+            return 0
+        if isinstance(item, str):
+            matches = self.count(item.lstrip('-'))
+            return self.total - matches if item.startswith('-') else matches
+        estimates = [self.estimate(x) for x in item.content]
+        if item.mode is Mode.AND:
+            matches = min(estimates, default=self.total)
+        else:
+            matches = min(sum(estimates), self.total)
+        return self.total - matches if item.invert else matches
+
+    def optimize(self, group: Group) -> _Item:
+        mode = group.mode
+        # The value that doesn't change the group's result (True for AND
+        # groups, False for OR groups)
+        neutral = mode is Mode.AND
+        content: Dict[str, Union[Group, str]] = {}
+        for item in group.content:
+            optimized: _Item
+            if isinstance(item, str):
+                optimized = f'-{item.lstrip("-")}' if item.startswith('-') \
+                    else item
+                if self.known is not None \
+                        and not self.known(optimized.lstrip('-')):
+                    # The tag doesn't exist, so nothing has it
+                    optimized = optimized.startswith('-')
+            else:
+                optimized = self.optimize(item)
+            if isinstance(optimized, Group) and optimized.invert \
+                    and optimized.mode is not mode:
+                # -(a | b) is -a, -b and -(a, b) is -a | -b
+                optimized = Group(mode, False, [_negate_content(x) for x
+                                                in optimized.content])
+            if isinstance(optimized, Group) and not optimized.invert \
+                    and optimized.mode is mode:
+                items: List[_Item] = list(optimized.content)
+            else:
+                items = [optimized]
+            for x in items:
+                if isinstance(x, bool):
+                    if x is neutral:
+                        continue
+                    # The group's result doesn't depend on the other items
+                    return x != group.invert
+                key = canonical_tag_filter(x)
+                if key in content:
+                    continue
+                negated = _negate(x)
+                assert not isinstance(negated, bool)
+                if canonical_tag_filter(negated) in content:
+                    # a, -a is never true and a | -a is always true
+                    return (not neutral) != group.invert
+                content[key] = x
+        if not content:
+            return neutral != group.invert
+        if len(content) == 1:
+            only_item = next(iter(content.values()))
+            return _negate(only_item) if group.invert else only_item
+        invert = group.invert
+        if invert and all(isinstance(x, str) for x in content.values()):
+            # -(a, b) is -a | -b and -(a | b) is -a, -b
+            mode = Mode.OR if mode is Mode.AND else Mode.AND
+            invert = False
+            content = {canonical_tag_filter(negated): negated
+                       for negated in map(_negate, content.values())
+                       if not isinstance(negated, bool)}
+        # Sorting by the key first makes the order the same for the same
+        # filter. An AND group is decided the fastest by starting with the
+        # item that matches the least, and an OR group by starting with the
+        # item that matches the most.
+        items_by_key = sorted(content.items())
+        items_by_key.sort(key=lambda key_item: self.estimate(key_item[1]),
+                          reverse=mode is Mode.OR)
+        return Group(mode, invert, [x for _, x in items_by_key])
+
+
+def optimize_tag_filter(tag_filter: Group,
+                        vocabulary: Optional[TagVocabulary] = None,
+                        count: Optional[Callable[[str], int]] = None,
+                        total: int = 0) -> Group:
+    """
+    Return a tag filter that matches the same tags as tag_filter, but with
+    less to check.
+
+    Negated groups of tags are replaced by groups of negated tags, groups
+    in groups with the same mode are flattened, duplicates are removed and
+    groups with only one item are replaced by the item. A group
+    that's always true or always false (eg. "a, -a") is replaced by a
+    constant: an empty AND group is always true and an empty OR group
+    always false.
+
+    If a vocabulary is specified, tags that aren't in it are treated as
+    tags that no entry has. If count (which returns how many of the total
+    entries have a tag) is specified, the items are ordered so that the
+    groups are decided as quickly as possible. Otherwise they're sorted,
+    so that the canonical form of the result is the same for equivalent
+    filters.
+    """
+    known: Optional[Callable[[str], bool]] = None
+    if vocabulary is not None:
+        # Not Optional, unlike vocabulary inside the function
+        tags = vocabulary
+
+        def is_known(tag: str) -> bool:
+            if '*' in tag:
+                return bool(tags.expand(tag))
+            return tag in tags
+        known = is_known
+    optimized = _Optimizer(known, count, total).optimize(tag_filter)
+    if isinstance(optimized, bool):
+        return Group(Mode.AND if optimized else Mode.OR, False, [])
+    elif isinstance(optimized, str):
+        return Group(Mode.OR, False, [optimized])
+    return optimized
+
+
+def estimate_tag_filter(tag_filter: Group, count: Callable[[str], int],
+                        total: int) -> int:
+    """
+    Return roughly how many of the total entries match the tag filter,
+    using count (which returns how many of them have a tag). It's exact for
+    a single tag, and an upper bound for AND groups of tags.
+    """
+    return _Optimizer(None, count, total).estimate(tag_filter)
@@ -0,0 +1,167 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from sapfo.taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
+                              ATTR_DESCRIPTION, ATTR_FILE, ATTR_INDEX,
+                              ATTR_LAST_MODIFIED, ATTR_METADATA_FILE,
+                              ATTR_TAGS, ATTR_TITLE, ATTR_WORDCOUNT, Entry,
+                              FilterPlan)
+
+# The entry list is a widget, so this needs the whole GUI stack
+pytest.importorskip('libsyntyche')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+from PyQt5 import QtGui  # noqa: E402
+from sapfo.common import DATA_DIR, Settings  # noqa: E402
+from sapfo.index import entrylist as entrylist_module  # noqa: E402
+from sapfo.index.entrylist import (EntryList,  # noqa: E402
+                                   FILTER_CACHE_SIZE)
+
+TITLES = ['Abbey', 'Abyss', 'Cabin', 'Dune', 'Aboard']
+
+
+def make_entry(n, title):
+    file = Path('/stories') / f'story{n}'
+    return Entry({
+        ATTR_TITLE: title,
+        ATTR_DESCRIPTION: '',
+        ATTR_TAGS: frozenset(),
+        ATTR_INDEX: n,
+        ATTR_BACKSTORY_WORDCOUNT: 0,
+        ATTR_BACKSTORY_PAGES: 0,
+        ATTR_WORDCOUNT: 100 * n,
+        ATTR_FILE: file,
+        ATTR_LAST_MODIFIED: 0.0,
+        ATTR_METADATA_FILE: file.with_name(f'.{file.name}.metadata'),
+    })
+
+
+@pytest.fixture
+def entry_list(tmp_path):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    settings, _ = Settings.load(tmp_path)
+    parent = QtWidgets.QWidget()
+    base_gui = (DATA_DIR / 'entry_layout.decl').read_text(encoding='utf-8')
+    entry_list = EntryList(parent, settings, True, tmp_path / 'state',
+                           base_gui, '')
+    entry_list.resize(600, 400)
+    entry_list.set_entries(tuple(make_entry(n, title)
+                                 for n, title in enumerate(TITLES)), None)
+    yield entry_list
+    parent.deleteLater()
+    app.processEvents()
+
+
+def set_title_filter(entry_list, payload):
+    entry_list.active_filters[ATTR_TITLE] = payload
+    entry_list.filter_()
+    return sorted(entry[ATTR_TITLE] for entry in entry_list.visible_entries)
+
+
+def test_filter_cache(entry_list, monkeypatch):
+    narrowed = []
+    select = FilterPlan.select
+
+    def spy(self, keys, entry, narrow=False):
+        narrowed.append(narrow)
+        return select(self, keys, entry, narrow)
+    monkeypatch.setattr(FilterPlan, 'select', spy)
+
+    assert set_title_filter(entry_list, 'un') == ['Dune']
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    assert entry_list.filter_timings
+    # A stricter filter only checks the entries that are already visible
+    assert set_title_filter(entry_list, 'abb') == ['Abbey']
+    # (the very first filter is stricter than no filter at all)
+    assert narrowed == [True, False, True]
+    # Going back to an earlier filter reuses its result
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    assert entry_list.filter_timings == []
+    assert narrowed == [True, False, True]
+
+
+def test_filter_cache_invalidated(entry_list):
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    assert set_title_filter(entry_list, 'aby') == ['Abyss']
+    pos = entry_list.find_visible(ATTR_TITLE, 'abyss')[0]
+    assert entry_list.edit_(pos, ATTR_TITLE, 'Chasm')
+    assert set_title_filter(entry_list, 'aby') == []
+    # The earlier result is stale, so it has to be filtered again
+    assert set_title_filter(entry_list, 'ab') == ['Abbey', 'Aboard', 'Cabin']
+    assert entry_list.filter_timings
+    assert entry_list.undo() == 1
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    assert set_title_filter(entry_list, 'aby') == ['Abyss']
+
+
+def test_filter_cache_size(entry_list):
+    for n in range(FILTER_CACHE_SIZE + 1):
+        set_title_filter(entry_list, f'x{n}')
+    assert len(entry_list._filter_cache) == FILTER_CACHE_SIZE
+    # The oldest result is the one that was dropped
+    set_title_filter(entry_list, 'x0')
+    assert entry_list.filter_timings
+    set_title_filter(entry_list, f'x{FILTER_CACHE_SIZE}')
+    assert entry_list.filter_timings == []
+
+
+def test_layout_cache(entry_list, monkeypatch):
+    laid_out = []
+    calc_entry_layout = entrylist_module.calc_entry_layout
+
+    def spy(entry, visible_pos, m, y, width):
+        laid_out.append(entry[ATTR_TITLE])
+        return calc_entry_layout(entry, visible_pos, m, y, width)
+    monkeypatch.setattr(entrylist_module, 'calc_entry_layout', spy)
+
+    def check_layouts():
+        y = 0
+        for item in entry_list.entry_items:
+            fresh = calc_entry_layout(item.entry, item.visible_pos,
+                                      entry_list.gui_model, y,
+                                      entry_list.width())
+            assert item.group.drawable.rect == fresh.drawable.rect
+            y += fresh.size().height()
+
+    groups = [item.group for item in entry_list.entry_items]
+    entry_list.sort()
+    entry_list.recalc_sizes()
+    assert laid_out == []
+    assert [item.group for item in entry_list.entry_items] == groups
+    check_layouts()
+    # Only the edited entry is laid out again
+    pos = entry_list.find_visible(ATTR_TITLE, 'dune')[0]
+    assert entry_list.edit_(pos, ATTR_DESCRIPTION, 'Sand')
+    assert laid_out == ['Dune']
+    check_layouts()
+    # Everything has to be laid out again for a new width
+    laid_out.clear()
+    entry_list.resize(300, 400)
+    entry_list.recalc_sizes()
+    assert sorted(laid_out) == sorted(TITLES)
+    check_layouts()
+
+
+def test_resize_keeps_indexes(entry_list):
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    tag_indexes = entry_list.tag_indexes
+    columns = entry_list.columns
+    texts = entry_list.texts
+    old_size = entry_list.size()
+    entry_list.resize(300, 400)
+    QtWidgets.QApplication.sendEvent(
+        entry_list, QtGui.QResizeEvent(entry_list.size(), old_size))
+    assert entry_list.tag_indexes is tag_indexes
+    assert entry_list.columns is columns
+    assert entry_list.texts is texts
+    # The filter result is still cached
+    assert set_title_filter(entry_list, 'ab') \
+        == ['Abbey', 'Aboard', 'Abyss', 'Cabin']
+    assert entry_list.filter_timings == []
@@ -0,0 +1,81 @@
+import sqlite3
+
+from sapfo.index.cache import DirState, IndexCache, StoryState
+from sapfo.taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
+                              ATTR_DESCRIPTION, ATTR_FILE, ATTR_INDEX,
+                              ATTR_LAST_MODIFIED, ATTR_METADATA_FILE,
+                              ATTR_TAGS, ATTR_TITLE, ATTR_WORDCOUNT,
+                              builtin_attrs, Entry)
+
+
+def make_state(file):
+    entry = Entry({
+        ATTR_TITLE: 'A story',
+        ATTR_DESCRIPTION: '',
+        ATTR_TAGS: frozenset(['b', 'a']),
+        ATTR_INDEX: 0,
+        ATTR_BACKSTORY_WORDCOUNT: 3,
+        ATTR_BACKSTORY_PAGES: 1,
+        ATTR_WORDCOUNT: 12,
+        ATTR_FILE: file,
+        ATTR_LAST_MODIFIED: 1234.5,
+        ATTR_METADATA_FILE: file.with_name(f'.{file.name}.metadata'),
+    })
+    return StoryState(1, 1234500000000, 60, entry, {})
+
+
+def test_save_and_load(tmp_path):
+    file = tmp_path / 'story'
+    state = make_state(file)
+    dir_state = DirState(5, (('story', False),), ('sub',))
+    cache = IndexCache(tmp_path / 'index.sqlite')
+    cache.save(builtin_attrs, {tmp_path: dir_state}, {file: state})
+    dirs, stories = IndexCache(tmp_path / 'index.sqlite').load(builtin_attrs)
+    assert dirs == {tmp_path: dir_state}
+    assert stories == {file: state}
+
+
+def test_remove(tmp_path):
+    file = tmp_path / 'story'
+    cache = IndexCache(tmp_path / 'index.sqlite')
+    cache.save(builtin_attrs, {}, {file: make_state(file)})
+    cache.save(builtin_attrs, {}, {file: None})
+    assert cache.load(builtin_attrs) == ({}, {})
+
+
+def test_other_attributes(tmp_path):
+    file = tmp_path / 'story'
+    cache = IndexCache(tmp_path / 'index.sqlite')
+    cache.save(['title'], {}, {file: make_state(file)})
+    assert cache.load(builtin_attrs) == ({}, {})
+
+
+def test_not_a_database(tmp_path):
+    path = tmp_path / 'index.sqlite'
+    path.write_bytes(b'\x80\x04garbage that used to be a pickle' * 100)
+    cache = IndexCache(path)
+    assert cache.load(builtin_attrs) == ({}, {})
+    file = tmp_path / 'story'
+    cache.save(builtin_attrs, {}, {file: make_state(file)})
+    assert IndexCache(path).load(builtin_attrs)[1] == {file: make_state(file)}
+
+
+def test_old_version(tmp_path):
+    path = tmp_path / 'index.sqlite'
+    db = sqlite3.connect(str(path))
+    db.execute('CREATE TABLE stories (file TEXT PRIMARY KEY)')
+    db.execute("INSERT INTO stories VALUES ('x')")
+    db.commit()
+    db.close()
+    assert IndexCache(path).load(builtin_attrs) == ({}, {})
+
+
+def test_broken_rows(tmp_path):
+    path = tmp_path / 'index.sqlite'
+    file = tmp_path / 'story'
+    IndexCache(path).save(builtin_attrs, {}, {file: make_state(file)})
+    db = sqlite3.connect(str(path))
+    db.execute("UPDATE stories SET metadata = 'not json'")
+    db.commit()
+    db.close()
+    assert IndexCache(path).load(builtin_attrs) == ({}, {})
@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sapfo.taggedlist import (ATTR_BACKSTORY_PAGES, ATTR_BACKSTORY_WORDCOUNT,
+                              ATTR_FILE, ATTR_TITLE, ATTR_WORDCOUNT,
+                              builtin_attrs)
+
+# The index's cache location comes from the (GUI) common module
+pytest.importorskip('libsyntyche')
+from sapfo.index import indexing  # noqa: E402
+from sapfo.index.indexing import (get_backstory_data,  # noqa: E402
+                                  IndexingCanceled, StoryIndex)
+
+
+class DummyProgress:
+    def setLabelText(self, text):
+        pass
+
+    def setMaximum(self, maximum):
+        pass
+
+    def setValue(self, progress):
+        pass
+
+    def wasCanceled(self):
+        return False
+
+
+class CancelingProgress(DummyProgress):
+    def __init__(self, checks):
+        self.checks = checks
+
+    def wasCanceled(self):
+        self.checks -= 1
+        return self.checks < 0
+
+
+def write_story(dir_root, name, title, text='one two three'):
+    (dir_root / name).write_text(text, encoding='utf-8')
+    metadata = {'title': title, 'description': '', 'tags': []}
+    (dir_root / f'.{name}.metadata').write_text(json.dumps(metadata),
+                                                encoding='utf-8')
+
+
+def write_page(story, name, text):
+    metadir = story.with_name(story.name + '.metadir')
+    metadir.mkdir(exist_ok=True)
+    (metadir / name).write_text(json.dumps({'title': name}) + '\n' + text,
+                                encoding='utf-8')
+    return metadir
+
+
+def make_index(tmp_path):
+    root = tmp_path / 'stories'
+    root.mkdir()
+    write_story(root, 'a.txt', 'A')
+    write_story(root, 'b.txt', 'B', 'four five')
+    index = StoryIndex(tmp_path / 'cache')
+    entries = index.update(root, DummyProgress(), builtin_attrs)
+    return root, index, entries
+
+
+def by_title(entries):
+    return {entry[ATTR_TITLE]: entry for entry in entries}
+
+
+def test_update(tmp_path):
+    root, index, entries = make_index(tmp_path)
+    assert sorted(by_title(entries)) == ['A', 'B']
+    assert by_title(entries)['B'][ATTR_WORDCOUNT] == 2
+    # A new index reads the same entries from the cache
+    index = StoryIndex(tmp_path / 'cache')
+    assert index.cached_entries(root, builtin_attrs) == entries
+    assert index.update(root, DummyProgress(), builtin_attrs) == entries
+
+
+def test_update_changes(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    (root / 'b.txt').rename(root / 'c.txt')
+    (root / '.b.txt.metadata').rename(root / '.c.txt.metadata')
+    (root / 'sub').mkdir()
+    write_story(root / 'sub', 'd.txt', 'D')
+    entries = index.update(root, DummyProgress(), builtin_attrs)
+    assert {entry[ATTR_TITLE]: entry[ATTR_FILE] for entry in entries} == {
+        'A': root / 'a.txt',
+        'B': root / 'c.txt',
+        'D': root / 'sub' / 'd.txt',
+    }
+
+
+def test_refresh_add(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    write_story(root, 'c.txt', 'C')
+    changes = index.refresh([root], builtin_attrs)
+    assert [entry[ATTR_TITLE] for entry in changes.entries] == ['C']
+    assert changes.removed == []
+    assert changes.errors == []
+
+
+def test_refresh_rename(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    (root / 'b.txt').rename(root / 'c.txt')
+    (root / '.b.txt.metadata').rename(root / '.c.txt.metadata')
+    changes = index.refresh([root], builtin_attrs)
+    assert [entry[ATTR_FILE] for entry in changes.entries] \
+        == [root / 'c.txt']
+    assert changes.removed == [root / 'b.txt']
+
+
+def test_refresh_delete(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    (root / 'a.txt').unlink()
+    (root / '.a.txt.metadata').unlink()
+    # The watcher reports the files as well as their directory
+    changes = index.refresh([root / 'a.txt', root / '.a.txt.metadata', root],
+                            builtin_attrs)
+    assert changes.entries == []
+    assert changes.removed == [root / 'a.txt']
+    # The removal is saved in the cache as well
+    assert [entry[ATTR_TITLE] for entry in StoryIndex(tmp_path / 'cache')
+            .cached_entries(root, builtin_attrs)] == ['B']
+
+
+def test_refresh_changed_file(tmp_path, monkeypatch):
+    root, index, _ = make_index(tmp_path)
+    # Make the stories look old, or they're never trusted to be unchanged
+    for path in root.iterdir():
+        os.utime(path, ns=(10**18, 10**18))
+    index.update(root, DummyProgress(), builtin_attrs)
+    (root / 'b.txt').write_text('four five six', encoding='utf-8')
+    # Only the directory is watched, so that's all the watcher reports
+    read = []
+    read_story = indexing._read_story
+
+    def spy(index, story, *args):
+        read.append(story.file.name)
+        return read_story(index, story, *args)
+    monkeypatch.setattr(indexing, '_read_story', spy)
+    changes = index.refresh([root], builtin_attrs)
+    assert [entry[ATTR_WORDCOUNT] for entry in changes.entries] == [3]
+    assert changes.removed == []
+    assert read == ['b.txt']
+
+
+def test_watched_paths(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    (root / 'sub').mkdir()
+    write_story(root / 'sub', 'c.txt', 'C')
+    metadir = write_page(root / 'a.txt', 'page1', 'a b c')
+    (metadir / 'notes').mkdir()
+    index.update(root, DummyProgress(), builtin_attrs)
+    assert sorted(index.watched_paths()) \
+        == [root, metadir, metadir / 'notes', root / 'sub']
+
+
+def test_refresh_backstory(tmp_path):
+    root, index, _ = make_index(tmp_path)
+    story = root / 'a.txt'
+    metadir = write_page(story, 'page1', 'a b c')
+    changes = index.refresh([root], builtin_attrs)
+    assert [(entry[ATTR_BACKSTORY_WORDCOUNT], entry[ATTR_BACKSTORY_PAGES])
+            for entry in changes.entries] == [(3, 1)]
+    # The backstory directory is watched, but isn't a story directory
+    assert metadir in index.watched_paths()
+    write_page(story, 'page2', 'd e')
+    changes = index.refresh([metadir], builtin_attrs)
+    assert [(entry[ATTR_BACKSTORY_WORDCOUNT], entry[ATTR_BACKSTORY_PAGES])
+            for entry in changes.entries] == [(5, 2)]
+    assert changes.removed == []
+
+
+def test_backstory_data_cache(tmp_path):
+    story = tmp_path / 'a.txt'
+    metadir = write_page(story, 'page1', 'a b c')
+    (metadir / 'sub').mkdir()
+    write_page(story, 'page2', 'd e')
+    os.replace(metadir / 'page2', metadir / 'sub' / 'page2')
+    # Recently modified files are never trusted to be unchanged
+    for path in [metadir / 'page1', metadir / 'sub' / 'page2',
+                 metadir / 'sub', metadir]:
+        os.utime(path, ns=(10**18, 10**18))
+    counted = []
+
+    def count(page):
+        counted.append(page.name)
+        text = page.read_text(encoding='utf-8')
+        return len(text.split('\n', 1)[1].split())
+
+    wordcount, pages, state = get_backstory_data(story, {}, count)
+    assert (wordcount, pages) == (5, 2)
+    assert sorted(counted) == ['page1', 'page2']
+    counted.clear()
+    assert get_backstory_data(story, state, count) == (5, 2, state)
+    assert counted == []
+    write_page(story, 'page1', 'a b c d')
+    os.utime(metadir / 'page1', ns=(10**18 + 10**9, 10**18 + 10**9))
+    wordcount, pages, new_state = get_backstory_data(story, state, count)
+    assert (wordcount, pages) == (6, 2)
+    assert counted == ['page1']
+    assert new_state[metadir / 'sub'] == state[metadir / 'sub']
+
+
+def test_count_in_processes_cancel(tmp_path, monkeypatch):
+    root = tmp_path / 'stories'
+    root.mkdir()
+    for n in range(100):
+        write_story(root, f'{n:03}.txt', str(n))
+    submitted = []
+
+    class Executor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(args)
+            return super().submit(fn, *args, **kwargs)
+
+    # Threads instead of processes, to see what gets counted
+    monkeypatch.setattr(indexing, 'ProcessPoolExecutor',
+                        lambda max_workers, mp_context:
+                        Executor(max_workers))
+    monkeypatch.setattr(indexing, '_MIN_PROCESS_JOBS', 1)
+    monkeypatch.setattr(indexing, '_PROCESS_BATCH_SIZE', 1)
+    counted = []
+    lock = threading.Lock()
+    count_words_batch = indexing.count_words_batch
+
+    def spy(jobs):
+        with lock:
+            counted.append(jobs)
+        return count_words_batch(jobs)
+    monkeypatch.setattr(indexing, 'count_words_batch', spy)
+    index = StoryIndex(tmp_path / 'cache')
+    with pytest.raises(IndexingCanceled):
+        index.update(root, CancelingProgress(0), builtin_attrs, processes=2)
+    # Only a few batches are queued at a time, and only those can have been
+    # counted
+    assert len(submitted) <= 4
+    assert 1 <= len(counted) <= len(submitted)
+    # Nothing is saved when the indexing is canceled
+    assert StoryIndex(tmp_path / 'cache').cached_entries(
+        root, builtin_attrs) == ()
@@ -0,0 +1,299 @@
+import random
+
+import pytest
+
+from sapfo.taggedlist import (builtin_attrs, Entry, EntryColumns, EntryTexts,
+                              FilterPlan, is_refinement, NONEMPTY_SEARCH)
+from sapfo.tagsystem import ParsingError, TagIndex, TagVocabulary
+
+ENTRIES = [
+    Entry({'title': 'The Dragon', 'description': '', 'wordcount': 1200,
+           'tags': frozenset(['fantasy', 'dragons'])}),
+    Entry({'title': 'Space', 'description': 'Stars and such',
+           'wordcount': 15000, 'tags': frozenset(['scifi'])}),
+    Entry({'title': 'Untitled', 'description': '', 'wordcount': 0,
+           'tags': frozenset()}),
+]
+
+
+@pytest.mark.parametrize(
+    'filters,titles',
+    [([], ['The Dragon', 'Space', 'Untitled']),
+     ([('title', 'dRaG')], ['The Dragon']),
+     ([('description', '')], ['The Dragon', 'Untitled']),
+     ([('description', NONEMPTY_SEARCH)], ['Space']),
+     ([('wordcount', '>1k')], ['The Dragon', 'Space']),
+     ([('wordcount', '>=1200<15k')], ['The Dragon']),
+     ([('tags', '')], ['Untitled']),
+     ([('tags', NONEMPTY_SEARCH)], ['The Dragon', 'Space']),
+     ([('tags', 'fantasy|scifi')], ['The Dragon', 'Space']),
+     ([('tags', '@nice')], ['The Dragon', 'Space']),
+     ([('tags', '-scifi')], ['The Dragon', 'Untitled']),
+     ([('tags', 'drag*')], ['The Dragon']),
+     ([('tags', '-scifi'), ('title', 'a')], ['The Dragon']),
+     ([('title', 'a'), ('wordcount', '>1k'), ('tags', 'scifi')], ['Space']),
+     ([('title', 'THE DRAGON')], ['The Dragon']),
+     ([('title', 'the dragons')], []),
+     ([('description', 'STARS'), ('title', 'ace')], ['Space']),
+     ])
+def test_filter_plan(filters, titles):
+    macros = {'nice': 'fantasy|scifi'}
+    plan = FilterPlan(filters, builtin_attrs, macros)
+    assert [e['title'] for e in ENTRIES if plan.matches(e)] == titles
+    assert [ENTRIES[n]['title'] for n in sorted(
+        plan.select(range(len(ENTRIES)), ENTRIES.__getitem__))] == titles
+    vocabulary = TagVocabulary(tag for e in ENTRIES for tag in e['tags'])
+    plan = FilterPlan(filters, builtin_attrs, macros, vocabulary)
+    assert [e['title'] for e in ENTRIES if plan.matches(e)] == titles
+    tag_index = TagIndex(vocabulary)
+    for n, e in enumerate(ENTRIES):
+        tag_index.add(n, e['tags'])
+    plan = FilterPlan(filters, builtin_attrs, macros, vocabulary,
+                      {'tags': tag_index})
+    keys = plan.indexed_matches()
+    assert [e['title'] for n, e in enumerate(ENTRIES)
+            if (keys is None or n in keys) and plan.matches(e)] == titles
+    columns = EntryColumns(builtin_attrs)
+    for n, e in enumerate(ENTRIES):
+        columns.update(n, e)
+    plan = FilterPlan(filters, builtin_attrs, macros, vocabulary,
+                      {'tags': tag_index}, columns)
+    keys = plan.indexed_matches()
+    assert [e['title'] for n, e in enumerate(ENTRIES)
+            if (keys is None or n in keys) and plan.matches(e)] == titles
+    texts = EntryTexts(builtin_attrs, ['title'])
+    for n, e in enumerate(ENTRIES):
+        texts.update(n, e)
+    plan = FilterPlan(filters, builtin_attrs, macros, vocabulary,
+                      {'tags': tag_index}, columns, texts)
+    keys = plan.indexed_matches()
+    assert [e['title'] for n, e in enumerate(ENTRIES)
+            if (keys is None or n in keys) and plan.matches(e)] == titles
+    keys = plan.select(range(len(ENTRIES)), ENTRIES.__getitem__)
+    assert [ENTRIES[n]['title'] for n in sorted(keys)] == titles
+    plan = FilterPlan(filters, builtin_attrs, macros)
+    keys = plan.select(range(len(ENTRIES)), ENTRIES.__getitem__)
+    assert [ENTRIES[n]['title'] for n in sorted(keys)] == titles
+
+
+def test_filter_plan_invalid_tag_filter():
+    with pytest.raises(ParsingError):
+        FilterPlan([('tags', 'a,b|c')], builtin_attrs, {})
+
+
+def test_filter_plan_key():
+    def key(filters):
+        return FilterPlan(filters, builtin_attrs, {'nice': 'scifi|fantasy'}
+                          ).key
+    assert key([('tags', 'fantasy, (dragons)')]) \
+        == key([('tags', 'dragons,fantasy')])
+    assert key([('tags', '@nice'), ('title', 'a')]) \
+        == key([('title', 'a'), ('tags', 'fantasy | scifi')])
+    assert key([('tags', 'fantasy')]) != key([('tags', '-fantasy')])
+    assert key([('title', 'a')]) != key([('description', 'a')])
+
+
+def test_filter_plan_order():
+    entries = [Entry({'title': f'Story {n}', 'description': 'A story',
+                      'wordcount': n, 'tags': frozenset(['a'] if n == 3
+                                                        else ['b'])})
+               for n in range(100)]
+    filters = [('description', 'story'), ('wordcount', '>=10'),
+               ('tags', 'a|c'), ('title', 'st')]
+    assert [attribute for attribute, _, _
+            in FilterPlan(filters, builtin_attrs, {}).predicates] \
+        == ['wordcount', 'description', 'title', 'tags']
+    tag_index = TagIndex()
+    columns = EntryColumns(builtin_attrs)
+    texts = EntryTexts(builtin_attrs, ['title'])
+    for n, entry in enumerate(entries):
+        tag_index.add(n, entry['tags'])
+        columns.update(n, entry)
+        texts.update(n, entry)
+    plan = FilterPlan(filters, builtin_attrs, {}, None, {'tags': tag_index},
+                      columns, texts)
+    assert plan.select(range(100), entries.__getitem__) == set()
+    # The most selective filter is run first, and nothing is left after
+    # the second one
+    assert [(t.attribute, t.payload, t.estimate, t.matches)
+            for t in plan.timings] \
+        == [('tags', 'a|c', 1, 1), ('wordcount', '>=10', 90, 0)]
+    plan = FilterPlan(filters[:2], builtin_attrs, {}, None,
+                      {'tags': tag_index}, columns, texts)
+    assert len(plan.select(range(100), entries.__getitem__)) == 90
+    assert [(t.attribute, t.estimate, t.matches) for t in plan.timings] \
+        == [('wordcount', 90, 90), ('description', 100, 90)]
+
+
+@pytest.mark.parametrize(
+    'payload',
+    ['', '>5', '>=5', '<5', '<=5', '>2<8', '>=2<=8', '>8<2', '>1k', '<=1k',
+     '>3>=6', '<9<4'])
+def test_entry_columns_select(payload):
+    values = [5, 3, 8, 1000, 5, 0, 2, 1001, 7, 6]
+    entries = [Entry({'wordcount': value}) for value in values]
+    columns = EntryColumns(builtin_attrs)
+    for n, entry in enumerate(entries):
+        columns.update(n, entry)
+    columns.remove(4)
+    matches = builtin_attrs['wordcount']._compile_filter(payload, {})
+    expected = {n for n, entry in enumerate(entries)
+                if n != 4 and matches(entry)}
+    assert columns.select('wordcount', payload) == expected
+    assert columns.count('wordcount', payload) >= len(expected)
+    for within in [set(), {1, 3, 4}, set(range(1, 10))]:
+        assert columns.select('wordcount', payload, within) \
+            == expected & within
+
+
+def test_entry_columns():
+    entries = [Entry({'wordcount': value, 'lastmodified': value / 2,
+                      'backstorypages': 'x' if value == 2 else value})
+               for value in [3, 1, 3, 2, 1]]
+    columns = EntryColumns(builtin_attrs)
+    for key, entry in zip('abcde', entries):
+        columns.update(key, entry)
+    assert 'wordcount' in columns
+    assert 'title' not in columns
+    # A column with a value that doesn't fit isn't used
+    assert 'backstorypages' not in columns
+    assert columns.select('wordcount', '>=3') == {'a', 'c'}
+    assert columns.select('lastmodified', '<1') == {'b', 'e'}
+    columns.update('b', Entry({'wordcount': 4, 'lastmodified': 0.0}))
+    columns.remove('c')
+    assert columns.select('wordcount', '>=3') == {'a', 'b'}
+    assert columns.select('lastmodified', '<1') == {'b', 'e'}
+
+
+def test_entry_columns_compact():
+    columns = EntryColumns(builtin_attrs)
+    for key in range(100):
+        columns.update(key, Entry({'wordcount': key}))
+    for key in range(0, 100, 4):
+        columns.remove(key)
+    # Not too many rows have been removed yet
+    assert len(columns.keys) == 100
+    for key in range(100, 1000):
+        columns.update(key, Entry({'wordcount': key}))
+        if key % 3 != 2:
+            columns.remove(key - 50)
+    # The removed rows don't pile up
+    assert len(columns.keys) < 2 * len(columns.rows)
+    assert len(columns.columns['wordcount']) == len(columns.keys)
+    live = set(columns.rows)
+    assert columns.select('wordcount', '') == live
+    assert columns.select('wordcount', '>500<=600') \
+        == {key for key in live if 500 < key <= 600}
+    assert columns.select('wordcount', '>=990', set(range(995))) \
+        == {key for key in live if 990 <= key < 995}
+
+
+@pytest.mark.parametrize(
+    'payload',
+    ['', NONEMPTY_SEARCH, 'a', 'dr', 'DRA', 'ragon', 'the d', 'nogard',
+     'strasse', 'ßE', 'a a', 'xyz', 'aaa', 'aaaa'])
+@pytest.mark.parametrize('trigram_attributes', [[], ['title']])
+def test_entry_texts_select(payload, trigram_attributes):
+    titles = ['The Dragon', 'dragons', '', 'Große Straße', 'A a A',
+              'aaa', 'The Dragon', 'drag on', 'AAAA']
+    entries = [Entry({'title': title}) for title in titles]
+    texts = EntryTexts(builtin_attrs, trigram_attributes)
+    for n, entry in enumerate(entries):
+        texts.update(n, entry)
+    texts.remove(6)
+    matches = builtin_attrs['title']._compile_filter(payload, {})
+    expected = {n for n, entry in enumerate(entries)
+                if n != 6 and matches(entry)}
+    assert texts.select('title', payload) == expected
+    for within in [set(), {0, 2, 5}, set(range(1, 9))]:
+        assert texts.select('title', payload, within) == expected & within
+    assert texts.estimate('title', payload) >= len(expected)
+
+
+def test_entry_texts():
+    texts = EntryTexts(builtin_attrs, ['title', 'description', 'tags'])
+    assert 'title' in texts
+    assert 'wordcount' not in texts
+    assert set(texts.trigrams) == {'title', 'description'}
+    texts.update('a', Entry({'title': 'The Dragon', 'description': 1}))
+    texts.update('b', Entry({'title': 'Dragonfly'}))
+    # An attribute with a value that isn't text isn't used
+    assert 'description' not in texts
+    assert texts.containing('title', 'DRAGON') == {'a', 'b'}
+    assert texts.containing('title', '') == {'a', 'b'}
+    texts.update('a', Entry({'title': 'Space'}))
+    assert texts.containing('title', 'dragon') == {'b'}
+    texts.remove('b')
+    texts.remove('c')
+    assert texts.containing('title', 'dragon') == set()
+    # Nothing is left of the removed texts in the index
+    assert set().union(*texts.trigrams['title'].values()) == {'a'}
+
+
+@pytest.mark.parametrize(
+    'old_filters,new_filters,result',
+    [([], [], True),
+     ([], [('title', 'a')], True),
+     ([('title', 'a')], [], False),
+     ([('title', 'dra')], [('title', 'drag')], True),
+     ([('title', 'dra')], [('title', 'Adrag')], True),
+     ([('title', 'drag')], [('title', 'dra')], False),
+     ([('title', 'dra')], [('title', 'dr')], False),
+     ([('title', 'dra')], [('description', 'drag')], False),
+     ([('title', NONEMPTY_SEARCH)], [('title', 'a')], True),
+     ([('title', 'a')], [('title', NONEMPTY_SEARCH)], False),
+     ([('title', '')], [('title', 'a')], False),
+     ([('title', 'a')], [('title', 'a'), ('wordcount', '>5')], True),
+     ([('wordcount', '>5')], [('wordcount', '>5<10')], True),
+     ([('wordcount', '>5')], [('wordcount', '>=6')], True),
+     ([('wordcount', '>5')], [('wordcount', '>=5')], False),
+     ([('wordcount', '>=5')], [('wordcount', '>5')], True),
+     ([('wordcount', '<1k')], [('wordcount', '<=999')], True),
+     ([('wordcount', '<=1k')], [('wordcount', '<1k')], True),
+     ([('wordcount', '<1k')], [('wordcount', '<=1k')], False),
+     ([('wordcount', '>5<10')], [('wordcount', '>5')], False),
+     ([('tags', 'a')], [('tags', 'a, b')], True),
+     ([('tags', 'a|b')], [('tags', '(b|a), c')], True),
+     ([('tags', 'a, b')], [('tags', 'b, a, -c')], True),
+     ([('tags', 'a, b')], [('tags', 'a')], False),
+     ([('tags', 'a')], [('tags', 'a|b')], False),
+     ([('tags', 'a')], [('tags', '@m, b')], True),
+     ([('tags', NONEMPTY_SEARCH)], [('tags', 'a')], False),
+     ([('tags', '')], [('tags', '')], True),
+     ])
+def test_is_refinement(old_filters, new_filters, result):
+    macros = {'m': 'a'}
+    assert is_refinement(old_filters, new_filters, builtin_attrs, macros) \
+        == result
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_is_refinement_random(seed):
+    rng = random.Random(seed)
+    entries = [Entry({'title': ''.join(rng.choices('ab', k=rng.randint(0, 4))),
+                      'wordcount': rng.randint(0, 10),
+                      'tags': frozenset(rng.sample('abc', rng.randint(0, 3)))})
+               for _ in range(50)]
+
+    def random_filters():
+        filters = []
+        if rng.random() < 0.7:
+            filters.append(('title', ''.join(rng.choices('ab',
+                                                         k=rng.randint(0, 3)))))
+        if rng.random() < 0.7:
+            filters.append(('wordcount', ''.join(
+                rng.choice(['<', '>', '<=', '>=']) + str(rng.randint(0, 10))
+                for _ in range(rng.randint(0, 2)))))
+        if rng.random() < 0.7:
+            filters.append(('tags', rng.choice(['a', 'b', 'a, b', 'a|c',
+                                                '-c', 'b, -c', '(a|c), b'])))
+        return filters
+
+    for _ in range(200):
+        old_filters = random_filters()
+        new_filters = random_filters()
+        if is_refinement(old_filters, new_filters, builtin_attrs, {}):
+            old_plan = FilterPlan(old_filters, builtin_attrs, {})
+            new_plan = FilterPlan(new_filters, builtin_attrs, {})
+            assert all(old_plan.matches(entry) for entry in entries
+                       if new_plan.matches(entry))
@@ -1,8 +1,14 @@
+import random
+
 import pytest
 
-from sapfo.tagsystem import (_expand_macros, _match, _tokenize,
-                             compile_tag_filter, Group, match_tag_filter,
-                             Mode, ParsingError, Token)
+from sapfo.tagsystem import (_match, _parse, _read_from, _tokenize,
+                             canonical_tag_filter, compile_tag_filter, compile_tag_mask,
+                             compile_tag_matcher, Group,
+                             match_tag_mask, Mode, optimize_tag_filter,
+                             ParsingError,
+                             resolve_tag_filter, TagIndex, TagMacros,
+                             TagVocabulary, Token)
 from sapfo.tagsystem import TokenType as TT
 
 
@@ -93,6 +99,71 @@ def test_compile(input_filter, wanted_group):
     assert compiled == wanted_group
 
 
+def read_from_recursive(tokens):
+    # The old recursive parser, to check the new one against
+    if not tokens:
+        raise ParsingError('No tokens')
+    modes = {TT.AND: Mode.AND, TT.OR: Mode.OR}
+    mode = None
+    groups = []
+    opening_token = tokens.pop(0)
+    if opening_token.type_ not in {TT.START_GROUP, TT.START_NEG_GROUP}:
+        raise ParsingError(f'Invalid syntax: expected a group but got '
+                           f'"{opening_token.lexeme}"')
+    invert = opening_token.type_ is TT.START_NEG_GROUP
+    while tokens:
+        token = tokens.pop(0)
+        if token.type_ is TT.END_GROUP:
+            if len(groups) == 1 and isinstance(groups[0], Group):
+                if invert:
+                    groups[0].invert = invert != groups[0].invert
+                return groups[0]
+            else:
+                return Group(mode, invert, groups)
+        elif token.type_ in {TT.START_GROUP, TT.START_NEG_GROUP}:
+            tokens.insert(0, token)
+            groups.append(read_from_recursive(tokens))
+        elif token.type_ in modes:
+            new_mode = modes[token.type_]
+            if mode is not None and mode is not new_mode:
+                raise ParsingError('Invalid syntax: mixed separators')
+            mode = new_mode
+        else:
+            groups.append(token.lexeme)
+    raise ParsingError('Invalid syntax: group wasn\'t closed')
+
+
+def parse_result(read, tokens):
+    try:
+        return read(tokens)
+    except ParsingError as e:
+        return str(e)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_read_from(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        string = ''.join(rng.choices('ab--(((),,||)))', k=rng.randint(1, 30)))
+        try:
+            tokens = _tokenize(string)
+        except ParsingError:
+            continue
+        assert parse_result(_read_from, tokens) \
+            == parse_result(read_from_recursive, list(tokens))
+    for tokens in [[], [Token(TT.NAME, 'a')], _tokenize('a, b')[:-1],
+                   _tokenize('a') + [Token(TT.END_GROUP, ')')]]:
+        assert parse_result(_read_from, tokens) \
+            == parse_result(read_from_recursive, list(tokens))
+
+
+def test_read_from_deep():
+    depth = 10000
+    tag_filter = _read_from(_tokenize('-(' * depth + 'a' + ')' * depth))
+    assert tag_filter.content == ['a']
+    assert tag_filter.invert is False
+
+
 @pytest.mark.parametrize(
     'tag,tags,should_match',
     [('a', {'a', 'b', 'c'}, True),
@@ -111,8 +182,42 @@ def test_match(tag, tags, should_match):
 def test_expand_macros():
     base = 'a, b, {}, c'
     macro = 'foo | bar | (x, y)'
-    assert _expand_macros(base.format('@macaron'),
-                          {'macaron': macro}) == base.format(f'({macro})')
+    assert compile_tag_filter(base.format('@macaron'), {'macaron': macro}) \
+        == compile_tag_filter(base.format(f'({macro})'), {})
+    assert compile_tag_filter(base.format('-@macaron'), {'macaron': macro}) \
+        == compile_tag_filter(base.format(f'-({macro})'), {})
+
+
+@pytest.mark.parametrize(
+    'macro_str,expanded_str',
+    [('@a', '(x | y)'),
+     ('@b', '((x | y), z)'),
+     ('-@b', '-((x | y), z)'),
+     ('-(@a)', '-((x | y))'),
+     ('@c', '-(x | y)'),
+     ('-@c', '(x | y)'),
+     ('@a | @b', '(x | y) | ((x | y), z)'),
+     ])
+def test_tag_macros(macro_str, expanded_str):
+    macros = TagMacros({'a': 'x | y', 'b': '@a, z', 'c': '-@a'})
+    assert compile_tag_filter(macro_str, macros) \
+        == compile_tag_filter(expanded_str, {})
+    # The macros aren't changed by being used
+    assert compile_tag_filter(macro_str, macros) \
+        == compile_tag_filter(expanded_str, {})
+
+
+def test_broken_tag_macros():
+    macros = TagMacros({'a': '@b | x', 'b': 'y, @c', 'c': '@a',
+                        'd': 'x, @missing', 'e': 'x', 'f': '(x'})
+    assert set(macros.groups) == {'e'}
+    assert macros.errors['a'] == 'Recursive tag macro: @a -> @b -> @c -> @a'
+    assert macros.errors['d'] == 'Unknown tag macro @missing'
+    assert set(macros.errors) == {'a', 'b', 'c', 'd', 'f'}
+    with pytest.raises(ParsingError):
+        compile_tag_filter('@b', macros)
+    with pytest.raises(ParsingError):
+        compile_tag_filter('@missing', macros)
 
 
 @pytest.mark.parametrize(
@@ -135,7 +240,7 @@ def test_expand_macros():
      ])
 def test_whole_pipeline(filter_str, tags, should_match):
     tag_filter = compile_tag_filter(filter_str, {})
-    assert match_tag_filter(tag_filter, tags) == should_match
+    assert tag_filter.matcher(tags) == should_match
 
 
 # Assert errors
@@ -155,3 +260,198 @@ def test_tokenize_errors(text):
 def test_compile_errors(filter_str):
     with pytest.raises(ParsingError):
         compile_tag_filter(filter_str, {})
+
+
+# Bitmasks
+
+def test_tag_vocabulary():
+    vocabulary = TagVocabulary(['a', 'b'])
+    assert vocabulary.mask(frozenset(['b'])) == 0b10
+    assert vocabulary.mask({'a', 'c'}) == 0b101
+    assert 'c' in vocabulary
+    assert vocabulary.pattern_mask('*') == 0b111
+    assert vocabulary.pattern_mask('x*') == 0
+
+
+@pytest.mark.parametrize('pattern', [
+    '*', 'a*', 'ab*', 'abc*', '*c', '*bc', 'a*c', '*b*', 'a*b*c', 'x*',
+    '*x', 'a.*', '*.c', 'a+*', '*é',
+])
+def test_tag_vocabulary_expand(pattern):
+    tags = ['a', 'ab', 'abc', 'abbc', 'bc', 'c', 'xc', 'a.c', 'aXc', 'a+b',
+            '(a)', 'café']
+    vocabulary = TagVocabulary(tags)
+    expected = {tag for tag in tags if _match(pattern, [tag])}
+    assert vocabulary.expand(pattern) == expected
+    vocabulary.intern('abcd')
+    assert vocabulary.expand(pattern) \
+        == {tag for tag in tags + ['abcd'] if _match(pattern, [tag])}
+
+
+@pytest.mark.parametrize(
+    'filter_str',
+    ['a, b, c', 'a | b | c', '-a | b | c', '-a', '-(a | b)', '(a, b) | x',
+     '-(a, b) | c', 'x*', '-x*', 'a, -(b | x*)', '-(-(a), -b)', 'missing',
+     '-missing'])
+@pytest.mark.parametrize(
+    'tags',
+    [set(), {'a'}, {'b'}, {'a', 'c'}, {'a', 'b', 'c'}, {'j', 'x'},
+     {'xerxes', 'arst'}, {'a', 'b', 'arst'}])
+def test_match_tag_mask(filter_str, tags):
+    vocabulary = TagVocabulary(['a', 'b', 'c', 'j', 'x', 'xerxes', 'arst'])
+    tag_filter = compile_tag_filter(filter_str, {})
+    mask_filter = resolve_tag_filter(tag_filter, vocabulary)
+    mask = vocabulary.mask(frozenset(tags))
+    expected = _parse(tag_filter, tags)
+    assert tag_filter.matcher(tags) == expected
+    assert match_tag_mask(mask_filter, mask) == expected
+    assert compile_tag_mask(mask_filter)(mask) == expected
+
+
+def random_group(rng, tags, depth):
+    content = []
+    for _ in range(rng.randint(1, 4)):
+        if depth > 0 and rng.random() < 0.3:
+            content.append(random_group(rng, tags, depth - 1))
+        else:
+            content.append(rng.choice(['', '-']) + rng.choice(tags))
+    return Group(rng.choice([Mode.AND, Mode.OR]), rng.random() < 0.3,
+                 content)
+
+
+def test_resolve_unknown_tags():
+    vocabulary = TagVocabulary(['a', 'b'])
+    mask_filter = resolve_tag_filter(
+        compile_tag_filter('(a, -missing) | (b, other)', {}), vocabulary)
+    assert list(vocabulary) == ['a', 'b']
+    assert compile_tag_mask(mask_filter)(vocabulary.mask({'a'}))
+    assert not compile_tag_mask(mask_filter)(vocabulary.mask({'b'}))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_compiled_matchers(seed):
+    rng = random.Random(seed)
+    vocabulary = TagVocabulary(['a', 'b', 'c', 'ab', 'abc', 'bc'])
+    tags = ['a', 'b', 'c', 'ab', 'bc', 'missing', 'a*', 'b*', '*c', 'x*']
+    for _ in range(50):
+        tag_filter = random_group(rng, tags, 3)
+        matcher = compile_tag_matcher(tag_filter)
+        mask_matcher = compile_tag_mask(resolve_tag_filter(tag_filter,
+                                                           vocabulary))
+        for _ in range(10):
+            oldtags = frozenset(rng.sample(list(vocabulary),
+                                           rng.randint(0, 4)))
+            expected = _parse(tag_filter, oldtags)
+            assert matcher(oldtags) == expected
+            assert mask_matcher(vocabulary.mask(oldtags)) == expected
+
+
+def test_tag_index():
+    tag_index = TagIndex()
+    tag_index.add(1, {'a', 'b'})
+    tag_index.add(2, {'b'})
+    tag_index.add(3, set())
+    assert tag_index.postings == {'a': {1}, 'b': {1, 2}}
+    tag_index.replace(1, {'a', 'b'}, {'c'})
+    tag_index.remove(2, {'b'})
+    assert tag_index.keys == {1, 3}
+    assert tag_index.postings == {'c': {1}}
+    assert 'a' in tag_index.vocabulary
+    assert tag_index.select(compile_tag_filter('-c', {})) == {3}
+    assert tag_index.select(compile_tag_filter('-c', {}), {1}) == set()
+    assert tag_index.estimate(compile_tag_filter('c', {})) == 1
+    assert tag_index.estimate(compile_tag_filter('-c', {})) == 1
+    assert tag_index.estimate(compile_tag_filter('c | missing', {})) == 1
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_tag_index_select(seed):
+    rng = random.Random(seed)
+    vocabulary = ['a', 'b', 'c', 'ab', 'abc', 'bc']
+    tags = ['a', 'b', 'c', 'ab', 'bc', 'missing', 'a*', 'b*', '*c', 'x*']
+    entries = [frozenset(rng.sample(vocabulary, rng.randint(0, 4)))
+               for _ in range(30)]
+    tag_index = TagIndex()
+    for n, entry_tags in enumerate(entries):
+        tag_index.add(n, entry_tags)
+    for _ in range(50):
+        tag_filter = random_group(rng, tags, 3)
+        assert tag_index.select(tag_filter) \
+            == {n for n, entry_tags in enumerate(entries)
+                if _parse(tag_filter, entry_tags)}
+
+
+# Optimizing
+
+@pytest.mark.parametrize(
+    'filter_str,optimized_str',
+    [('a, b, (c, d)', '(a,b,c,d)'),
+     ('b | (a | c)', '(a|b|c)'),
+     ('-(a | b), c', '(-a,-b,c)'),
+     ('-(a, b) | c', '(-a|-b|c)'),
+     ('a | a | b', '(a|b)'),
+     ('--a', '(-a)'),
+     ('-(-(a))', '(a)'),
+     ('-(-a | b)', '(-b,a)'),
+     ('a, -a', '(|)'),
+     ('a | -a | b', '(,)'),
+     ('b, (a | -a)', '(b)'),
+     ('a, (x, -x)', '(|)'),
+     ('a, (b | c), (c | b)', '((b|c),a)'),
+     ])
+def test_optimize_tag_filter(filter_str, optimized_str):
+    optimized = optimize_tag_filter(compile_tag_filter(filter_str, {}))
+    assert canonical_tag_filter(optimized) == optimized_str
+
+
+@pytest.mark.parametrize(
+    'filter_str,optimized_str',
+    [('a, missing', '(|)'),
+     ('a | missing', '(a)'),
+     ('a, -missing', '(a)'),
+     ('x*', '(|)'),
+     ('-x*', '(,)'),
+     ('a*, b', '(a*,b)'),
+     ])
+def test_optimize_tag_filter_vocabulary(filter_str, optimized_str):
+    vocabulary = TagVocabulary(['a', 'ab', 'b'])
+    optimized = optimize_tag_filter(compile_tag_filter(filter_str, {}),
+                                    vocabulary)
+    assert canonical_tag_filter(optimized) == optimized_str
+
+
+def test_optimize_tag_filter_order():
+    counts = {'a': 10, 'b': 1, 'c': 5}
+    optimized = optimize_tag_filter(compile_tag_filter('a, b, c', {}),
+                                    count=counts.get, total=20)
+    assert optimized.content == ['b', 'c', 'a']
+    optimized = optimize_tag_filter(compile_tag_filter('a | b | c', {}),
+                                    count=counts.get, total=20)
+    assert optimized.content == ['a', 'c', 'b']
+
+
+def shuffled(rng, group):
+    content = [x if isinstance(x, str) else shuffled(rng, x)
+               for x in group.content]
+    rng.shuffle(content)
+    return Group(group.mode, group.invert, content)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_optimize_tag_filter_random(seed):
+    rng = random.Random(seed)
+    vocabulary = TagVocabulary(['a', 'b', 'c', 'ab', 'abc', 'bc'])
+    tags = ['a', 'b', 'c', 'ab', 'bc', 'missing', 'a*', 'b*', '*c', 'x*']
+    for _ in range(50):
+        tag_filter = random_group(rng, tags, 3)
+        optimized = optimize_tag_filter(tag_filter)
+        with_vocabulary = optimize_tag_filter(tag_filter, vocabulary)
+        assert canonical_tag_filter(optimize_tag_filter(
+            shuffled(rng, tag_filter))) == canonical_tag_filter(optimized)
+        for _ in range(10):
+            oldtags = frozenset(rng.sample(list(vocabulary),
+                                           rng.randint(0, 4)))
+            expected = _parse(tag_filter, oldtags)
+            assert _parse(optimized, oldtags) == expected
+            assert _parse(with_vocabulary, oldtags) == expected
+            assert with_vocabulary.matcher(oldtags) == expected
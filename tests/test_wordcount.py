@@ -0,0 +1,54 @@
+import pytest
+
+from sapfo.index.wordcount import count_words
+
+TEXTS = [
+    '',
+    'word',
+    '\n',
+    '  leading and trailing  ',
+    'tabs\tand\nnewlines\r\nand\x0bmore\x0cspace',
+    'non-ascii wörds å ä ö',
+    'ideographic　space and\xa0nbsp',
+    '日本語 の テキスト',
+    'next\x85line separator',
+]
+
+
+@pytest.mark.parametrize('text', TEXTS)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 1 << 16])
+def test_count_words(tmp_path, text, chunk_size):
+    file = tmp_path / 'story'
+    file.write_text(text, encoding='utf-8')
+    assert count_words(file, chunk_size=chunk_size) == len(text.split())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1 << 16])
+def test_count_words_skip_first_line(tmp_path, chunk_size):
+    file = tmp_path / 'page'
+    file.write_text('{"title": "a b c"}\nthe rest åf the page\n',
+                    encoding='utf-8')
+    assert count_words(file, skip_first_line=True, chunk_size=chunk_size) == 5
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+def test_count_words_skip_first_line_newlines(tmp_path, newline):
+    file = tmp_path / 'page'
+    file.write_bytes(newline.join(['{"title": "a b c"}', 'the rest',
+                                   'of the page', '']).encode('utf-8'))
+    assert count_words(file, skip_first_line=True) == 5
+
+
+@pytest.mark.parametrize('text', ['', 'only a header'])
+def test_count_words_skip_missing_first_line(tmp_path, text):
+    file = tmp_path / 'page'
+    file.write_text(text, encoding='utf-8')
+    with pytest.raises(ValueError):
+        count_words(file, skip_first_line=True)
+
+
+def test_count_words_invalid_utf8(tmp_path):
+    file = tmp_path / 'story'
+    file.write_bytes(b'broken \xff text')
+    with pytest.raises(UnicodeDecodeError):
+        count_words(file)
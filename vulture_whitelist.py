@@ -3,6 +3,7 @@ _.mousePressEvent  # unused method (sapfo/backstorywindow.py:128)
 _.closeEvent  # unused method (sapfo/backstorywindow.py:322)
 _.horizontal_align  # unused property (sapfo/declin/parsing.py:256)
 _.paintEvent  # unused method (sapfo/index/entrylist.py:96)
+_.run  # unused method (sapfo/index/loader.py:82)
 _.minimumSizeHint  # unused method (sapfo/index/entrylist.py:125)
 _.paintEvent  # unused method (sapfo/index/taginfolist.py:22)
 _.closeEvent  # unused method (sapfo/sapfo.py:62)